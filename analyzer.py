@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import os.path
-import mpmath
+import re
 import argparse
 import sdpdatafile
 import simplelogger
@@ -12,6 +12,12 @@ validtrlist = ['maxComplementarity exceeded',
                'found dual feasible solution',
                'found primal-dual optimal solution']
 
+primaltrlist = ['found primal feasible solution',
+                'primal feasible jump detected']
+
+dualtrlist = ['found dual feasible solution',
+              'dual feasible jump detected']
+
 
 def addcounter(filename):
     filenameroot, filenamext = os.path.splitext(filename)
@@ -23,7 +29,60 @@ def addcounter(filename):
         return filenamebare + maybecounter + '.count001' + filenamext
 
 
+def trialfilename(filename, i):
+    """
+    The filename of trial i of a k-section round called filename.
+    """
+    filenameroot, filenamext = os.path.splitext(roundfilename(filename))
+    return filenameroot + '.t' + str(i) + filenamext
+
+
+def roundfilename(filename):
+    """
+    The name of the k-section round of a trial, i.e. without '.tN'.
+    """
+    filenameroot, filenamext = os.path.splitext(filename)
+    filenamebare, maybetrial = os.path.splitext(filenameroot)
+    if re.fullmatch(r'\.t\d+', maybetrial):
+        return filenamebare + filenamext
+    return filename
+
+
+def claimfilename(filename):
+    """
+    The hidden marker file of the k-section round called filename.
+    """
+    path, file = os.path.split(filename)
+    return os.path.join(path, '.' + file + '.claimed')
+
+
+def claimround(filename):
+    """
+    Claim the creation of the k-section round called filename, by creating
+    its marker file. Only the first trial to try succeeds, even when
+    several are analyzed at the same time.
+    """
+    try:
+        os.close(os.open(claimfilename(filename),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+
+def warmstartupdate(sdpdata, newcheckpointfile):
+    """
+    Update for the successor of sdpdata in a search with <warmstart/>: it
+    starts from the checkpoint of sdpdata, and writes its own checkpoint to
+    newcheckpointfile so that it does not overwrite the one it started from.
+    The worker falls back to a cold start if sdpb rejects the checkpoint.
+    """
+    return {'sdpbData': {'warmstart': sdpdata.checkpointfile,
+                         'params': {'checkpointFile': newcheckpointfile}}}
+
+
 def nextinbinarysearch(sdpdata, tr):
+    import mpmath
     sdpdict = sdpdata.dict
     analyzerdict = sdpdict.get('analyzer')
     oldprimal = mpmath.mpf(analyzerdict.get('primalpt'))
@@ -32,12 +91,10 @@ def nextinbinarysearch(sdpdata, tr):
     threshold = mpmath.mpf(analyzerdict.get('threshold'))
     varval = mpmath.mpf(sdpdict.get('sdpFileData').get(varname))
 
-    if tr == 'found primal feasible solution' or \
-            tr == 'primal feasible jump detected':
+    if tr in primaltrlist:
         newprimal = varval
         newdual = olddual
-    elif tr == 'found dual feasible solution' or \
-            tr == 'dual feasible jump detected':
+    elif tr in dualtrlist:
         newprimal = oldprimal
         newdual = varval
     else:
@@ -46,11 +103,14 @@ def nextinbinarysearch(sdpdata, tr):
     newvarval = (newdual + newprimal)/2
 
     newfilename = addcounter(sdpdata.filename)
-    newsdpdataw = sdpdatafile.SdpDataFileWriter(newfilename)
-    newsdpdataw.updatefile(sdpdict)
-    newsdpdataw.updatefile({'analyzer': {'primalpt': newprimal,
-                                         'dualpt': newdual}})
-    newsdpdataw.updatefile({'sdpFileData': {varname: newvarval}})
+    newsdpdataw = sdpdatafile.SdpDataFileWriter(newfilename, sdpdict)
+    with newsdpdataw.transaction() as t:
+        t.update({'analyzer': {'primalpt': newprimal, 'dualpt': newdual}})
+        t.update({'sdpFileData': {varname: newvarval}})
+        if 'warmstart' in analyzerdict and \
+                sdpdata.checkpointfile is not None:
+            t.update(warmstartupdate(
+                sdpdata, addcounter(sdpdata.checkpointfile)))
 
     if abs(newdual - newprimal) <= threshold:
         newsdpdata = sdpdatafile.SdpDataFile(newfilename)
@@ -62,9 +122,110 @@ def nextinbinarysearch(sdpdata, tr):
         return newfilename
 
 
+def nextinksection(sdpdata, tr):
+    """
+    Like a binary search, but every round tries k evenly spaced points
+    between primalpt and dualpt at once, in the trial files of the round.
+    The trial that finishes last narrows the bracket using all k outcomes
+    and creates the next round. Returns the new trial files or None.
+    """
+    import mpmath
+    sdpdict = sdpdata.dict
+    analyzerdict = sdpdict.get('analyzer')
+    k = int(analyzerdict.get('k'))
+    oldprimal = mpmath.mpf(analyzerdict.get('primalpt'))
+    olddual = mpmath.mpf(analyzerdict.get('dualpt'))
+    varname = analyzerdict.get('varname')
+    threshold = mpmath.mpf(analyzerdict.get('threshold'))
+    varval = mpmath.mpf(sdpdict.get('sdpFileData').get(varname))
+
+    if tr not in primaltrlist + dualtrlist:
+        raise ValueError('not sure what to do with terminateReason: ' + tr)
+
+    if analyzerdict.get('trial') is None:
+        # the file we started from tries a single point
+        thisround = sdpdata.filename
+        outcomes = [(varval, tr)]
+    else:
+        thisround = roundfilename(sdpdata.filename)
+        outcomes = []
+        for i in range(1, k + 1):
+            trialname = trialfilename(thisround, i)
+            if trialname == sdpdata.filename:
+                outcomes.append((varval, tr))
+                continue
+            trialdata = sdpdatafile.SdpDataFile(trialname)
+            log = simplelogger.LogState.get(trialdata.logfilename)
+            if log.status == 'failed':
+                # no information from this one
+                continue
+            elif log.status not in ['finished', 'concluded']:
+                # a later trial will create the next round
+                return None
+            trialtr = log.last.get('terminateReason')
+            if trialtr not in primaltrlist + dualtrlist:
+                # timed out; it is resubmitted and will get here itself
+                return None
+            trialval = trialdata.dict.get('sdpFileData').get(varname)
+            outcomes.append((mpmath.mpf(trialval), trialtr))
+
+    nextround = addcounter(thisround)
+    if os.path.isfile(nextround) or \
+            os.path.isfile(trialfilename(nextround, 1)) or \
+            not claimround(nextround):
+        # another trial of this round got here first
+        return None
+
+    # walk from primalpt towards dualpt until the first dual outcome
+    newprimal = oldprimal
+    newdual = olddual
+    for val, valtr in sorted(outcomes,
+                             key=lambda o: abs(o[0] - oldprimal)):
+        if valtr in primaltrlist:
+            newprimal = val
+        elif valtr in dualtrlist:
+            newdual = val
+            break
+
+    if abs(newdual - newprimal) <= threshold:
+        newsdpdataw = sdpdatafile.SdpDataFileWriter(nextround, sdpdict)
+        newsdpdataw.updatefile({'analyzer': {'primalpt': newprimal,
+                                             'dualpt': newdual}})
+        newsdpdata = sdpdatafile.SdpDataFile(nextround)
+        newlogw = simplelogger.SimpleLogWriter('ana', newsdpdata.logfilename)
+        newlogw.write('k-section search ended')
+        newlogw.setstatus('concluded')
+        return None
+
+    newfilenames = []
+    for i in range(1, k + 1):
+        newvarval = newprimal + (newdual - newprimal) * i / (k + 1)
+        newfilename = trialfilename(nextround, i)
+        # trials run at the same time, so they need their own sdp files
+        sdpfilename = sdpdict.get('sdpFileData').get('filename')
+        newsdpdataw = sdpdatafile.SdpDataFileWriter(newfilename, sdpdict)
+        with newsdpdataw.transaction() as t:
+            t.update({'analyzer': {'primalpt': newprimal,
+                                   'dualpt': newdual,
+                                   'trial': i}})
+            t.update({'sdpFileData': {varname: newvarval}})
+            if sdpfilename is not None:
+                t.update({'sdpFileData': {
+                    'filename': trialfilename(sdpfilename, i)}})
+            if 'warmstart' in analyzerdict and \
+                    sdpdata.checkpointfile is not None:
+                newcheckpointfile = addcounter(
+                    roundfilename(sdpdata.checkpointfile))
+                t.update(warmstartupdate(
+                    sdpdata, trialfilename(newcheckpointfile, i)))
+        newfilenames.append(newfilename)
+    return newfilenames
+
+
 def analyze(sdpdata, tr, primopt):
     """
-    Analyzes an xml file and returns a filename with a new sdpb run, or none.
+    Analyzes an xml file and returns a filename with a new sdpb run, a list
+    of them, or none.
     """
     newfilename = None
     if tr is None:
@@ -77,6 +238,8 @@ def analyze(sdpdata, tr, primopt):
     if analyzerdict is not None:
         if 'binarysearch' in analyzerdict.keys():
                 newfilename = nextinbinarysearch(sdpdata, tr)
+        elif 'ksection' in analyzerdict.keys():
+                newfilename = nextinksection(sdpdata, tr)
         elif 'maximumsearch' in analyzerdict.keys():
                 raise NotImplementedError("Maximum search not implemented")
         else:
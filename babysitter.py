@@ -4,40 +4,125 @@ import argparse
 import datetime
 import sdpdatafile
 import simplelogger
-import analyzer
+import campaign
 import os.path
 import sys
 import manyworlds
 import subprocess as sp
-# from multiprocessing.dummy import Pool as ThreadPool
+import threading
+import time
+import fcntl
+from multiprocessing.dummy import Pool as ThreadPool
 
 parser = argparse.ArgumentParser()
-parser.add_argument('filenames', metavar='fn', nargs='+',
+parser.add_argument('filenames', metavar='fn', nargs='*',
                     help="""A number of sdp data files to handle.""")
 parser.add_argument('-w', '--world', choices=['local', 'cern', 'fake'],
                     help="""Select the local environment.""", required=True)
 parser.add_argument('-m', '--maxsubmissions', type=int, default=10,
                     help="""Maximum number of submissions of a job.""")
 parser.add_argument('-p', '--pause', action='store_true',
-                    help="""Wait for completion of jobs.""")
+                    help="""Wait for completion of jobs. Jobs are handled
+                            again as soon as they complete, in whichever
+                            order that happens.""")
 parser.add_argument('-r', '--reallyrunning', action='store_true',
                     help="""Query the cluster to see if job is really running.
                             Resubmit if this is not the case.""")
 parser.add_argument('-f', '--force', action='store_true',
                     help="""force resubmission of a 'failed' job'""")
+parser.add_argument('-b', '--batch', action='store_true',
+                    help="""Collect all submissions of this run and submit
+                            them together at the end.""")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="""Number of files to handle in parallel. Output is
+                            collected per file and reported in the order in
+                            which the files were given.""")
+parser.add_argument('-d', '--daemon', action='store_true',
+                    help="""Keep running, and handle a file again only when
+                            its xml or log file changed. Replacement files
+                            are picked up automatically. Only one daemon
+                            runs per directory.""")
+parser.add_argument('-i', '--interval', type=float, default=60,
+                    help="""Seconds between two sweeps of the daemon.""")
+parser.add_argument('-c', '--compact', type=int, metavar='LINES',
+                    help="""Compact the log of a finished job when it has
+                            more than this many entries, before handling it
+                            (see simplelogger.compactlog).""")
+parser.add_argument('-M', '--manifest',
+                    help="""A campaign manifest. The given files are added
+                            to it, and only the files in it that are not
+                            concluded or failed yet are handled. It is kept
+                            up to date with their statuses and
+                            replacements.""")
 
-args = parser.parse_args()
-sdpDataFilenames = args.filenames
-if not all(map(os.path.isfile, sdpDataFilenames)):
-    print('Could not find sdp data file(s)', file=sys.stderr)
-    exit(1)
-sdpDataFilenames = list(map(os.path.abspath, sdpDataFilenames))
-world = manyworlds.getworld(args.world)
+# set up by setup(), so that the babysitter can also be driven from Python
+args = None
+world = None
+
+
+def setup(argv=None, newworld=None):
+    """
+    Parse the command line arguments (argv, or sys.argv) and set up the
+    world, unless one is given. Returns the files to handle.
+    """
+    global args, world
+    args = parser.parse_args(argv)
+    if args.daemon and args.pause:
+        parser.error('a daemon does not pause')
+    if not args.filenames and args.manifest is None:
+        parser.error('no sdp data files or manifest given')
+    sdpDataFilenames = args.filenames
+    if not all(map(os.path.isfile, sdpDataFilenames)):
+        print('Could not find sdp data file(s)', file=sys.stderr)
+        exit(1)
+    sdpDataFilenames = list(map(os.path.abspath, sdpDataFilenames))
+    if args.manifest is not None:
+        try:
+            with campaign.Manifest(args.manifest).locked() as manifest:
+                for filename in sdpDataFilenames:
+                    manifest.add(filename)
+                sdpDataFilenames = manifest.active(args.force)
+        except ValueError as e:
+            parser.error(str(e))
+    # go straight to the heads of the chains, past their concluded steps
+    sdpDataFilenames = campaign.ChainIndex.jump(sdpDataFilenames)
+    world = newworld if newworld is not None \
+        else manyworlds.getworld(args.world)
+    return sdpDataFilenames
+
+
+# per-thread output buffer, set while handling files in parallel
+_output = threading.local()
+
+
+def inlineprint(expr, end=' '):
+    buffer = getattr(_output, 'buffer', None)
+    if buffer is not None:
+        buffer.append(str(expr) + end)
+    else:
+        print(expr, end=end, flush=True)
+
+
+# files waiting for submission in --batch mode
+pending = []
+_pendinglock = threading.Lock()
+# with --pause: file per submission id that we wait for, and the
+# submission ids that have ended
+waiting = {}
+ended = set()
+_waitinglock = threading.Lock()
 
-def inlineprint(expr):
-    print(expr, end=' ', flush=True)
 
 def submit(sdpdata):
+    """
+    Submit sdpdata and return the submission id. In --batch mode the file
+    is queued for submitpending instead and None is returned.
+    """
+    if args.batch:
+        with _pendinglock:
+            pending.append(sdpdata)
+        inlineprint('queued for batch submission.')
+        return None
     logw = simplelogger.SimpleLogWriter('sub', sdpdata.logfilename)
     # log submission time
     now = str(datetime.datetime.now())
@@ -48,101 +133,364 @@ def submit(sdpdata):
         logw.write('submissionerror', e.returncode)
         logw.setstatus('failed')
         raise
+    logsubmission(sdpdata, submissionid, now)
+    return submissionid
+
+
+def logsubmission(sdpdata, submissionid, now):
+    logw = simplelogger.SimpleLogWriter('sub', sdpdata.logfilename)
     # logw processid
     logw.setstatus('submitted')
     logw.write('submissionid', submissionid)
     logw.write('submissiontime', now)
-    return submissionid
+
+
+def submitpending():
+    """
+    Submit all files queued in --batch mode at once and return them.
+    """
+    with _pendinglock:
+        batch = pending[:]
+        del pending[:]
+    if not batch:
+        return batch
+    now = str(datetime.datetime.now())
+    try:
+        submissionids = world.submitmany(batch)
+    except sp.CalledProcessError as e:
+        # some jobs may have been queued before the failure
+        submissionids = getattr(e, 'submissionids', [None] * len(batch))
+        for sdpdata, submissionid in zip(batch, submissionids):
+            if submissionid is not None:
+                logsubmitted(sdpdata, submissionid, now)
+                continue
+            logw = simplelogger.SimpleLogWriter('sub', sdpdata.logfilename)
+            logw.write('submissionerror', e.returncode)
+            logw.setstatus('failed')
+        raise
+    for sdpdata, submissionid in zip(batch, submissionids):
+        logsubmitted(sdpdata, submissionid, now)
+    return batch
+
+
+def logsubmitted(sdpdata, submissionid, now):
+    logsubmission(sdpdata, submissionid, now)
+    print(os.path.basename(sdpdata.filename) + ' : submitted as ' +
+          str(submissionid) + '.')
 
 
 def handle(filename):
-    sdpdata = sdpdatafile.SdpDataFile(filename)
+    sdpdata = sdpdatafile.SdpDataFile.cached(filename)
+    # keep other babysitters (or threads) away from this file meanwhile
+    with simplelogger.locklog(sdpdata.logfilename) as locked:
+        if not locked:
+            inlineprint('locked by another babysitter.')
+        elif args.compact is not None and \
+                simplelogger.LogState.get(sdpdata.logfilename).status == \
+                'finished' and \
+                simplelogger.compactlog(sdpdata.logfilename,
+                                        minlines=args.compact):
+            inlineprint('compacted log.')
+            # the log is a new file now, with a lock of its own
+            with simplelogger.locklog(sdpdata.logfilename) as relocked:
+                if relocked:
+                    _handle(filename)
+                else:
+                    inlineprint('locked by another babysitter.')
+        else:
+            _handle(filename)
 
-    log = simplelogger.SimpleLogReader(sdpdata.logfilename)
+
+def capturedhandle(filename):
+    """
+    Handle a file and return what would have been printed, so that files
+    can be handled in parallel and reported in a deterministic order.
+    """
+    _output.buffer = []
+    try:
+        inlineprint(os.path.basename(filename) + ' :')
+        handle(filename)
+    finally:
+        report = ''.join(_output.buffer)
+        _output.buffer = None
+    return report
+
+
+def _handle(filename):
+    sdpdata = sdpdatafile.SdpDataFile.cached(filename)
+
+    # one snapshot of the log answers all questions below
+    log = simplelogger.LogState.get(sdpdata.logfilename)
     logw = simplelogger.SimpleLogWriter('sub', sdpdata.logfilename)
 
-    status = log.getstatus()
+    status = log.status
 
     if status == 'concluded':
         inlineprint('all done.')
     elif status is None or status == 'tosubmit':
         inlineprint('submitting...')
-        submit(sdpdata)
-        handle(filename)
+        if submit(sdpdata) is not None:
+            _handle(filename)
     elif status == 'failed':
         if args.force:
             inlineprint('failed; forced resubmission...')
-            submit(sdpdata)
-            handle(filename)
+            if submit(sdpdata) is not None:
+                _handle(filename)
         else:
             inlineprint('failed.')
     elif status == 'submitted' or status == 'running':
         inlineprint('submitted.')
         if args.reallyrunning:
             inlineprint('checking...')
-            submissionid = log.lastbonusexprwith(expr='submissionid')
+            submissionid = log.last.get('submissionid')
             if world.isreallyrunning(submissionid):
                 inlineprint('is really running.')
             else:
                 inlineprint('is NOT really running:')
                 logw.setstatus('failed')
-                handle(filename)
+                _handle(filename)
         if args.pause:
-            inlineprint('waiting for completion...')
-            submissionid = log.lastbonusexprwith(expr='submissionid')
-            world.waitforcompletion(submissionid)
-            inlineprint('completed.')
-            handle(filename)
+            submissionid = log.last.get('submissionid')
+            if submissionid in ended:
+                # we saw it end, but it never reported back
+                inlineprint('ended without finishing:')
+                logw.write('job ended without finishing')
+                logw.setstatus('failed')
+                _handle(filename)
+            else:
+                inlineprint('waiting for completion...')
+                with _waitinglock:
+                    waiting[submissionid] = filename
     elif status == 'finished':
-        tr = log.lastbonusexprwith(expr='terminateReason')
-        primopt = log.lastbonusexprwith(expr='primalObjective')
+        tr = log.last.get('terminateReason')
+        primopt = log.last.get('primalObjective')
         if tr == 'maxRuntime exceeded' or \
                 tr == 'maxIterations exceeded':
             inlineprint('ran out of time.')
             if args.maxsubmissions and \
-                    log.numlineswith(expr='status', bonusexpr='submitted') >= \
+                    log.submissions >= \
                     args.maxsubmissions:
                 inlineprint('too many submissions to resubmit.')
                 logw.write('too many submissions.')
                 logw.setstatus('failed')
-                handle(filename)
+                _handle(filename)
             else:
                 inlineprint('resubmitting... ')
-                submit(sdpdata)
-                handle(filename)
+                if submit(sdpdata) is not None:
+                    _handle(filename)
         else:  # i.e. terminateReason is not timed out
+            # only needed here, and slow to import (mpmath)
+            import analyzer
+            start = time.time()
             try:
                 newfilename = analyzer.analyze(sdpdata, tr, primopt)
             except ValueError:
                 logw.write('analyzer failed with ValueError')
                 logw.setstatus('failed')
                 inlineprint('could not analyze the result.')
-                handle(filename)
+                _handle(filename)
             else:
+                simplelogger.SimpleLogWriter('tim', sdpdata.logfilename) \
+                    .write('analyzer', '{:.3f}'.format(time.time() - start))
                 logw.setstatus('concluded')
                 if newfilename is None:
                     inlineprint('done.')
+                    campaign.ChainIndex.recordreplacement(filename, [])
                 elif newfilename == filename:
                     inlineprint('resubmitting according to analyzer...')
                     logw.setstatus('tosubmit')
-                    handle(filename)
+                    _handle(filename)
                 else:
-                    print('replaced -->')
-                    inlineprint(os.path.basename(newfilename) + ' :')
-                    logw.write('replaced with', newfilename)
-                    handle(newfilename)
+                    # a k-section search replaces one file with several
+                    if not isinstance(newfilename, list):
+                        newfilename = [newfilename]
+                    campaign.ChainIndex.recordreplacement(filename,
+                                                          newfilename)
+                    for newfile in newfilename:
+                        inlineprint('replaced -->', end='\n')
+                        inlineprint(os.path.basename(newfile) + ' :')
+                        logw.write('replaced with', newfile)
+                        handle(newfile)
     else:
         # How did you get here?
-        print('Unknown status for ' + filename + '!')
+        inlineprint('Unknown status for ' + filename + '!', end='\n')
+
+
+def prefetch(filenames):
+    """
+    Let the world look up all submissions we may ask about in one go.
+    """
+    submissionids = []
+    for filename in filenames:
+        sdpdata = sdpdatafile.SdpDataFile.cached(filename)
+        log = simplelogger.LogState.get(sdpdata.logfilename)
+        submissionid = log.last.get('submissionid')
+        if log.status in ['submitted', 'running'] and submissionid:
+            submissionids.append(submissionid)
+    world.prefetch(submissionids)
+
+
+def handleall(filenames):
+    if args.reallyrunning:
+        prefetch(filenames)
+    if args.jobs > 1:
+        pool = ThreadPool(args.jobs)
+        for report in pool.imap(capturedhandle, filenames):
+            print(report)
+        pool.close()
+        pool.join()
+    else:
+        for filename in filenames:
+            inlineprint(os.path.basename(filename) + ' :')
+            handle(filename)
+            print()
+
+
+def flushpending():
+    batch = submitpending()
+    if batch and args.pause:
+        # start waiting for the batch
+        handleall([sdpdata.filename for sdpdata in batch])
+
+
+def waitall():
+    """
+    With --pause: wait for all outstanding submissions at once, and handle
+    each file as soon as its job completes.
+    """
+    while waiting:
+        for submissionid in world.waitforany(sorted(waiting)):
+            filename = waiting.pop(submissionid)
+            ended.add(submissionid)
+            inlineprint(os.path.basename(filename) + ' :')
+            inlineprint('completed.')
+            handle(filename)
+            print()
+        flushpending()
 
 
-# Parallel version:
-# pool = ThreadPool(len(sdpDataFilenames))
-# results = pool.map(handle, sdpDataFilenames)
-# pool.close()
-# pool.join()
+def updatemanifest(filenames):
+    """
+    Record what became of the files in the manifest, if any, and of the
+    active files in it, which the chain index may have jumped over.
+    """
+    if args.manifest is not None:
+        with campaign.Manifest(args.manifest).locked() as manifest:
+            manifest.update(list(filenames) + manifest.active(args.force))
+
+
+def signature(filename):
+    """
+    What we look at to decide whether a file may need handling again: the
+    stat of its xml and the version of its log.
+    """
+    st = os.stat(filename)
+    return ((st.st_ino, st.st_size, st.st_mtime_ns),
+            simplelogger.LogState.get(filename + '.log').version)
+
+
+def isterminal(filename):
+    status = simplelogger.LogState.get(filename + '.log').status
+    return status == 'concluded' or (status == 'failed' and not args.force)
+
+
+def isactionable(filename):
+    """
+    Whether the babysitter has something to do for the file, whether or not
+    it changed: submit it, or analyze its result.
+    """
+    status = simplelogger.LogState.get(filename + '.log').status
+    return status in [None, 'tosubmit', 'finished'] or \
+        (status == 'failed' and args.force)
+
+
+def daemon(filenames):
+    """
+    Sweep the files every --interval seconds and handle those that changed
+    since we last handled them (and, with -r, those that should be running).
+    Files are no longer watched once they are concluded or failed, or when
+    they were removed (e.g. by cleanup.py). Stops when no files are left.
+    """
+    lockdir = os.path.commonpath([os.path.dirname(f) for f in filenames])
+    with open(os.path.join(lockdir, '.babysitter.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print('Another babysitter daemon is running in ' + lockdir,
+                  file=sys.stderr)
+            exit(1)
+        watched = list(filenames)
+        seen = {}
+        while True:
+            # files removed meanwhile are forgotten; looking at their logs
+            # would create them again
+            watched = [filename for filename in watched
+                       if os.path.isfile(filename)]
+            tohandle = []
+            for filename in watched:
+                # taken before handling: whatever a worker writes meanwhile
+                # counts as a change at the next sweep
+                sig = signature(filename)
+                if sig != seen.get(filename) or isactionable(filename):
+                    tohandle.append(filename)
+                    seen[filename] = sig
+                elif args.reallyrunning and \
+                        simplelogger.LogState.get(filename + '.log').status \
+                        in ['submitted', 'running']:
+                    tohandle.append(filename)
+            if tohandle:
+                print(str(datetime.datetime.now()) + ':')
+                handleall(tohandle)
+                flushpending()
+            # watch the replacements as well; they were handled already
+            for filename in list(tohandle):
+                log = simplelogger.LogState.get(filename + '.log')
+                for newfilename in log.replacements:
+                    if newfilename not in watched:
+                        watched.append(newfilename)
+                        tohandle.append(newfilename)
+                        if os.path.isfile(newfilename):
+                            seen[newfilename] = signature(newfilename)
+            if tohandle:
+                updatemanifest(tohandle)
+            # their replacements are watched already
+            watched = [filename for filename in watched
+                       if os.path.isfile(filename) and
+                       not isterminal(filename)]
+            seen = {filename: seen[filename] for filename in watched
+                    if filename in seen}
+            if not watched:
+                print('All files concluded or failed.')
+                return
+            time.sleep(args.interval)
+
+
+def tick(filenames):
+    """
+    One run of the babysitter over the files.
+    """
+    handleall(filenames)
+    flushpending()
+    waitall()
+    updatemanifest(filenames)
+
+
+def main(argv=None):
+    sdpDataFilenames = setup(argv)
+    if not sdpDataFilenames:
+        if args.manifest is not None:
+            print('No active files in ' + args.manifest + '.')
+        else:
+            print('All chains concluded.')
+        return
+    if args.daemon:
+        try:
+            daemon(sdpDataFilenames)
+        except KeyboardInterrupt:
+            pass
+    else:
+        tick(sdpDataFilenames)
+
 
-for sdpDataFilename in sdpDataFilenames:
-    inlineprint(os.path.basename(sdpDataFilename) + ' :')
-    handle(sdpDataFilename)
-    print()
+if __name__ == "__main__":
+    main()
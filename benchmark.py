@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import glob
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+import analyzer
+import babysitter
+import campaign
+import fakeworld
+import sdpdatafile
+import simplelogger
+
+# the sdp data file every synthetic job starts from: a binary search
+template = """<sdp>
+<analyzer>
+    <binarysearch/>
+    <varname>gap</varname>
+    <primalpt>0</primalpt>
+    <dualpt>10</dualpt>
+    <threshold>1e-30</threshold>
+</analyzer>
+<sdpFileData>
+    <function>feasibilitySDPSingle</function>
+    <filename>work/bench_sdpb.xml</filename>
+    <gap>5</gap>
+</sdpFileData>
+<sdpbData>
+    <params>
+        <precision>200</precision>
+    </params>
+    <autosdpFiles />
+</sdpbData>
+</sdp>
+"""
+
+
+class BenchWorld(fakeworld.FakeWorld):
+    """
+    A FakeWorld that keeps quiet and hands out submission ids, after
+    pretending that submitting takes submitlatency seconds.
+    """
+
+    def __init__(self, submitlatency=0):
+        self.submitlatency = submitlatency
+        self.submissions = itertools.count(1)
+
+    def submit(self, sdpdata, options=None):
+        time.sleep(self.submitlatency)
+        return 'bench-' + str(next(self.submissions))
+
+    def isreallyrunning(self, submissionid):
+        return True
+
+
+class PhaseTimer:
+    """
+    Accumulates the time spent in, and the number of calls of, functions
+    wrapped with wrap. Phases may nest: the analyzer scans logs, too.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def wrap(self, phase, function):
+        self.seconds.setdefault(phase, 0.)
+        self.calls.setdefault(phase, 0)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[phase] += time.perf_counter() - start
+                self.calls[phase] += 1
+        return timed
+
+    def reset(self):
+        for phase in self.seconds:
+            self.seconds[phase] = 0.
+            self.calls[phase] = 0
+
+
+def instrument(timer):
+    ET.parse = timer.wrap('xmlparse', ET.parse)
+    simplelogger.LogState.get = classmethod(
+        timer.wrap('logscan', simplelogger.LogState.get.__func__))
+    analyzer.analyze = timer.wrap('analyzer', analyzer.analyze)
+    babysitter.submit = timer.wrap('submit', babysitter.submit)
+
+
+def synthesize(directory, jobs, loglength, depth, index=False):
+    """
+    Create a campaign of binary searches in directory: every job is a chain
+    of depth concluded and replaced files, ending in a finished file that
+    the next tick analyzes. Every log has loglength entries. With index, the
+    chains are recorded in a campaign.ChainIndex, as the babysitter would.
+    Returns all sdp data files.
+    """
+    root = ET.fromstring(template)
+    filenames = []
+    for job in range(jobs):
+        filename = os.path.join(directory, 'job' + str(job) + '.xml')
+        for step in range(depth + 1):
+            writer = sdpdatafile.SdpDataFileWriter(filename, root)
+            writer.updatefile({'sdpFileData': {'gap': 5 + step}})
+            newfilename = analyzer.addcounter(filename)
+            entries = [('sub', 'status', 'submitted'),
+                       ('sub', 'submissionid', 'bench-0'),
+                       ('run', 'status', 'running')]
+            entries += [('sdp', 'progress', 'iteration=' + str(i))
+                        for i in range(max(0, loglength - 7))]
+            entries += [('run', 'terminateReason',
+                         'found primal feasible solution'),
+                        ('run', 'primalObjective', '0'),
+                        ('run', 'status', 'finished')]
+            if step < depth:
+                entries += [('sub', 'status', 'concluded'),
+                            ('sub', 'replaced with', newfilename)]
+            with open(filename + '.log', 'w') as log:
+                log.writelines(simplelogger.SimpleLogWriter._formatline(*entry)
+                               for entry in entries)
+            if index and step < depth:
+                campaign.ChainIndex.recordreplacement(filename, [newfilename])
+            filenames.append(filename)
+            filename = newfilename
+    return filenames
+
+
+def tickfiles(directory, usemanifest):
+    """
+    The files given to a tick: all of them, as a cron job would with
+    *.xml, or none with a manifest.
+    """
+    if usemanifest:
+        return []
+    return sorted(glob.glob(os.path.join(directory, '*.xml')))
+
+
+def runtick(filenames, options, world):
+    """
+    One babysitter tick over the files, with its output swallowed. Returns
+    its duration.
+    """
+    filenames = babysitter.setup(['-w', 'fake'] + options + filenames, world)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        babysitter.tick(filenames)
+    return time.perf_counter() - start
+
+
+def forget():
+    # every campaign starts with cold caches
+    sdpdatafile.SdpDataFile._cache.clear()
+    simplelogger.LogState._cache.clear()
+
+
+def benchmark(jobs, loglength, depth, repeats, usemanifest, useindex,
+              options, submitlatency, timer):
+    """
+    Time a cold tick on a fresh campaign and a warm tick right after it,
+    repeats times, and measure the peak memory of a cold tick. Phase times
+    and tick times are medians over the repeats.
+    """
+    ticks = {'cold': [], 'warm': []}
+    phases = {'cold': [], 'warm': []}
+    calls = {}
+    peakmemory = None
+    for repeat in range(repeats + 1):
+        directory = tempfile.mkdtemp(prefix='sdpbench')
+        try:
+            filenames = synthesize(directory, jobs, loglength, depth,
+                                   useindex)
+            tickoptions = list(options)
+            if usemanifest:
+                manifestfilename = os.path.join(directory, 'campaign.tsv')
+                with campaign.Manifest(manifestfilename).locked() as manifest:
+                    manifest.update(filenames)
+                tickoptions += ['-M', manifestfilename]
+            forget()
+            world = BenchWorld(submitlatency)
+            if repeat == repeats:
+                # the last round only measures memory; tracing is slow
+                tracemalloc.start()
+                runtick(tickfiles(directory, usemanifest), tickoptions, world)
+                peakmemory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                continue
+            for kind in ['cold', 'warm']:
+                timer.reset()
+                ticks[kind].append(runtick(tickfiles(directory, usemanifest),
+                                           tickoptions, world))
+                phases[kind].append(dict(timer.seconds))
+                calls[kind] = dict(timer.calls)
+        finally:
+            shutil.rmtree(directory)
+    result = {'parameters': {'jobs': jobs, 'loglength': loglength,
+                             'depth': depth, 'manifest': usemanifest,
+                             'index': useindex},
+              'peakmemory': peakmemory}
+    for kind in ['cold', 'warm']:
+        result[kind] = {
+            'tick': statistics.median(ticks[kind]),
+            'ticks': ticks[kind],
+            'phases': {phase: statistics.median(p[phase]
+                                                for p in phases[kind])
+                       for phase in timer.seconds},
+            'calls': calls[kind]}
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare tick times and peak memory with those of the same parameters in
+    baseline. Returns the comparisons and whether any of them regressed by
+    more than a factor tolerance.
+    """
+    basebyparameters = {json.dumps(r['parameters'], sort_keys=True): r
+                        for r in baseline['results']}
+    comparisons = []
+    regressed = False
+    for result in results:
+        base = basebyparameters.get(
+            json.dumps(result['parameters'], sort_keys=True))
+        if base is None:
+            continue
+        ratios = {'cold': result['cold']['tick'] / base['cold']['tick'],
+                  'warm': result['warm']['tick'] / base['warm']['tick'],
+                  'peakmemory': result['peakmemory'] / base['peakmemory']}
+        comparisons.append({'parameters': result['parameters'],
+                            'ratios': ratios})
+        if any(ratio > tolerance for ratio in ratios.values()):
+            regressed = True
+    return comparisons, regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Time babysitter ticks on synthetic campaigns in a fake
+                       world, and report the results as JSON. Campaigns are
+                       made for every combination of the values given.""")
+    parser.add_argument('-n', '--jobs', type=int, nargs='+', default=[100],
+                        help="""number of jobs (binary searches)""")
+    parser.add_argument('-l', '--loglength', type=int, nargs='+',
+                        default=[100],
+                        help="""number of entries in every log""")
+    parser.add_argument('-d', '--depth', type=int, nargs='+', default=[5],
+                        help="""number of replaced files before the head of
+                                every chain""")
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help="""number of timed ticks per campaign size""")
+    parser.add_argument('-M', '--manifest', action='store_true',
+                        help="""let the babysitter use a campaign manifest
+                                instead of all files""")
+    parser.add_argument('-x', '--index', action='store_true',
+                        help="""record the chains in a chain index, so that
+                                the babysitter jumps to their heads""")
+    parser.add_argument('-j', '--babysitterjobs', type=int, default=1,
+                        help="""the --jobs option of the babysitter""")
+    parser.add_argument('-s', '--submitlatency', type=float, default=0,
+                        help="""seconds that a fake submission takes""")
+    parser.add_argument('-o', '--output',
+                        help="""write the JSON here instead of to stdout""")
+    parser.add_argument('-b', '--baseline',
+                        help="""JSON of an earlier run to compare with; exit
+                                with status 1 on a regression""")
+    parser.add_argument('-t', '--tolerance', type=float, default=1.25,
+                        help="""ratio to the baseline that counts as a
+                                regression""")
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error('at least one repeat is needed')
+
+    timer = PhaseTimer()
+    instrument(timer)
+    options = ['-j', str(args.babysitterjobs)]
+    results = []
+    for jobs, loglength, depth in itertools.product(args.jobs, args.loglength,
+                                                    args.depth):
+        results.append(benchmark(jobs, loglength, depth, args.repeats,
+                                 args.manifest, args.index, options,
+                                 args.submitlatency, timer))
+    report = {'python': platform.python_version(),
+              'results': results}
+    regressed = False
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['comparisons'], regressed = \
+            compare(results, baseline, args.tolerance)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if regressed:
+        exit(1)
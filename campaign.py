@@ -0,0 +1,244 @@
+import contextlib
+import fcntl
+import os
+import simplelogger
+
+# statuses after which nothing happens to a job without --force
+terminalstatuses = ['concluded', 'failed']
+
+
+class Manifest:
+    """
+    The jobs of a campaign, so that a babysitter does not have to open every
+    file (and log) it ever created to find the few that are still active.
+
+    The manifest is a small text file with one line per sdp data file: its
+    path, the head of its 'replaced with' chain (the file itself if it was
+    not replaced) and its last known status, separated by tabs. Paths are
+    relative to the manifest, so a campaign directory can be moved.
+
+    Use it as
+        with Manifest(filename).locked() as manifest:
+            ...
+    to read, modify and write it without interference from other
+    babysitters.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.directory = os.path.dirname(self.filename)
+        # path -> [head, status]
+        self.entries = {}
+
+    def _abspath(self, path):
+        return os.path.normpath(os.path.join(self.directory, path))
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.directory)
+
+    def load(self):
+        """
+        Read the manifest, if it exists. Raises ValueError for a file in
+        another format, such as the point list of sweep.py.
+        """
+        self.entries = {}
+        try:
+            with open(self.filename) as f:
+                for number, line in enumerate(f, 1):
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 3 or \
+                            fields[2] not in simplelogger.statuses + ['']:
+                        raise ValueError(
+                            self.filename + ', line ' + str(number) +
+                            ': not a campaign manifest (path, head and '
+                            'status separated by tabs)')
+                    path, head, status = fields
+                    self.entries[self._abspath(path)] = \
+                        [self._abspath(head), status or None]
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        tmpfilename = self.filename + '.tmp'
+        with open(tmpfilename, 'w') as f:
+            for path, (head, status) in self.entries.items():
+                f.write('\t'.join([self._relpath(path), self._relpath(head),
+                                   status or '']) + '\n')
+        os.replace(tmpfilename, self.filename)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.load()
+            yield self
+            self.save()
+
+    def add(self, filename):
+        filename = os.path.abspath(filename)
+        if filename not in self.entries:
+            self.entries[filename] = [filename, None]
+
+    def remove(self, filename):
+        self.entries.pop(os.path.abspath(filename), None)
+
+    def active(self, force=False):
+        """
+        The files that a babysitter still needs to look at. With force, the
+        failed files are among them.
+        """
+        terminal = ['concluded'] if force else terminalstatuses
+        return [path for path, (head, status) in self.entries.items()
+                if status not in terminal]
+
+    def replaced(self):
+        """
+        The concluded files that were replaced by others.
+        """
+        return [path for path, (head, status) in self.entries.items()
+                if status == 'concluded' and head != path]
+
+    def update(self, filenames):
+        """
+        Record the status of the files from their logs, together with the
+        files that replaced them, and move the heads of all chains that
+        they continue.
+        """
+        tovisit = [os.path.abspath(filename) for filename in filenames]
+        seen = set()
+        while tovisit:
+            filename = tovisit.pop()
+            if filename in seen:
+                continue
+            seen.add(filename)
+            log = simplelogger.LogState.get(filename + '.log')
+            replacements = [os.path.abspath(newfilename)
+                            for newfilename in log.replacements]
+            # a k-section search continues in the last one
+            head = replacements[-1] if replacements else filename
+            self.entries[filename] = [head, log.status]
+            tovisit += replacements
+        for entry in self.entries.values():
+            # the entries of heads lead to the heads of chains
+            while entry[0] in self.entries and \
+                    self.entries[entry[0]][0] != entry[0]:
+                entry[0] = self.entries[entry[0]][0]
+
+
+class ChainIndex:
+    """
+    The 'replaced with' chains of the files in a directory: for every chain
+    its root (the file it started from), its members, its current heads and
+    its depth (the number of replacements so far). A chain has several
+    heads during a k-section search.
+
+    The babysitter records every replacement, and every file that concluded
+    without one, and jumps from any member of a chain straight to its
+    heads, so that a tick never has to walk through the concluded steps.
+
+    The index is kept in the hidden file indexname in the directory, as a
+    journal with one line per record: the replaced file and its
+    replacements, separated by tabs and relative to the directory.
+    Recording only appends a line; reading replays them all.
+    """
+
+    indexname = '.sdpchains'
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.filename = os.path.join(self.directory, self.indexname)
+        # root -> {'depth': ..., 'heads': [...], 'members': [...]}
+        self.chains = {}
+        # member -> root
+        self.roots = {}
+
+    def _abspath(self, path):
+        return os.path.normpath(os.path.join(self.directory, path))
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.directory)
+
+    def load(self):
+        self.chains = {}
+        self.roots = {}
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    filenames = [self._abspath(path)
+                                 for path in line.rstrip('\n').split('\t')]
+                    self.record(filenames[0], filenames[1:])
+        except FileNotFoundError:
+            pass
+
+    def record(self, filename, newfilenames):
+        """
+        Record that filename was replaced with newfilenames, or, without
+        them, that it concluded without a replacement, like all but one of
+        the trials of a k-section round. Files concluding outside of a chain
+        are of no interest.
+        """
+        root = self.roots.get(filename)
+        if root is None:
+            if not newfilenames:
+                return
+            root = filename
+            self.chains[root] = {'depth': 0, 'heads': [root],
+                                 'members': [root]}
+            self.roots[root] = root
+        chain = self.chains[root]
+        chain['heads'] = [head for head in chain['heads'] if head != filename]
+        for newfilename in newfilenames:
+            if newfilename not in chain['heads']:
+                chain['heads'].append(newfilename)
+            if newfilename not in self.roots:
+                chain['members'].append(newfilename)
+                self.roots[newfilename] = root
+        if newfilenames:
+            chain['depth'] += 1
+
+    def append(self, filename, newfilenames):
+        """
+        Add a record to the journal. Others may append at the same time.
+        """
+        line = '\t'.join(self._relpath(os.path.abspath(path))
+                         for path in [filename] + newfilenames) + '\n'
+        with open(self.filename, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+
+    def heads(self, filename):
+        """
+        The heads of the chain of filename: none if the chain ended, or
+        filename itself if it is not part of a chain (or if the heads were
+        removed).
+        """
+        root = self.roots.get(filename)
+        if root is None:
+            return [filename]
+        heads = self.chains[root]['heads']
+        if not heads:
+            return []
+        return [head for head in heads if os.path.isfile(head)] or [filename]
+
+    @classmethod
+    def recordreplacement(cls, filename, newfilenames):
+        filename = os.path.abspath(filename)
+        cls(os.path.dirname(filename)).append(filename, newfilenames)
+
+    @classmethod
+    def jump(cls, filenames):
+        """
+        Replace every file by the heads of its chain, reading the index of
+        every directory once. Every head appears once, in order.
+        """
+        indices = {}
+        heads = []
+        for filename in map(os.path.abspath, filenames):
+            directory = os.path.dirname(filename)
+            if directory not in indices:
+                indices[directory] = cls(directory)
+                indices[directory].load()
+            for head in indices[directory].heads(filename):
+                if head not in heads:
+                    heads.append(head)
+        return heads
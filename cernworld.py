@@ -1,8 +1,12 @@
 
 import subprocess as sp
 import os
+import re
+import threading
+import time
 import manyworlds
-import htcondor as htc
+import deltasync
+import sdpcache
 
 
 class CernWorld(manyworlds.World):
@@ -13,13 +17,36 @@ class CernWorld(manyworlds.World):
     sdpb = bindir + 'sdpb'
 
     def __init__(self):
-        pass
+        # one schedd connection and one set of job ads per babysitter run
+        self.schedd = None
+        self.jobads = {}
+        self._lock = threading.Lock()
+        # how far we have read each user log, and the jobs seen ending there
+        self._logoffsets = {}
+        self._endedjobs = set()
 
     @staticmethod
     def _hide(filename):
         path, file = os.path.split(filename)
         return os.path.join(path, '.' + file)
 
+    def artifacts(self, sdpdata):
+        files = [self._hide(sdpdata.filename + ext)
+                 for ext in ['.condorlog', '.out', '.err']]
+        cerndict = sdpdata.dict.get('cernworld')
+        transferdict = cerndict.get('filetransfer') \
+            if hasattr(cerndict, 'get') else None
+        if hasattr(transferdict, 'get'):
+            # the copies that warmup and cooldown transfer
+            destdir = transferdict.get('origdestdir') or self.afsdir
+            for file in sdpdata.xmlfilenames + \
+                    [sdpdata.outfile, sdpdata.checkpointfile,
+                     sdpdata.backupcheckpointfile]:
+                if file is not None:
+                    files += [destdir + file,
+                              deltasync.signaturefilename(destdir + file)]
+        return files
+
     def warmup(self, sdpdata, log=None):
         cerndict = sdpdata.dict.get('cernworld')
         transferdict = cerndict.get('filetransfer')
@@ -30,50 +57,89 @@ class CernWorld(manyworlds.World):
             origdir = self.afsdir
         files = []
         if 'xmlfiles' in transferdict:
-            files += sdpdata.xmlfilenames
+            files += [(file, self._isdelta(transferdict, 'xmlfiles'))
+                      for file in sdpdata.xmlfilenames]
         if 'ckfile' in transferdict:
-            files += [sdpdata.checkpointfile]
-        for file in files:
-            # We allow 'file' to contain a relative path.
-            origfile = origdir + file
-            self.copyfile(origfile, file, log)
+            delta = self._isdelta(transferdict, 'ckfile')
+            files += [(sdpdata.checkpointfile, delta)]
+            # the checkpoint of the previous step to warm start from
+            if sdpdata.warmstartfile is not None:
+                files += [(sdpdata.warmstartfile, delta)]
+        # We allow 'file' to contain a relative path.
+        self.copyfiles([(origdir + file, file, delta)
+                        for file, delta in files], log)
 
     def cooldown(self, sdpdata, tr, log=None):
         cerndict = sdpdata.dict.get('cernworld')
         transferdict = cerndict.get('filetransfer')
         if transferdict is None:
             return
-        if 'onlyontimeout' in transferdict and \
-           tr != 'maxRuntime exceeded' and \
-           tr != 'maxIterations exceeded':
-            return
         destdir = transferdict.get('origdestdir')
         if destdir is None:
             destdir = self.afsdir
         files = []
+        if 'onlyontimeout' in transferdict and \
+           tr != 'maxRuntime exceeded' and \
+           tr != 'maxIterations exceeded':
+            # but the next step of a search may warm start from our checkpoint
+            analyzerdict = sdpdata.dict.get('analyzer')
+            if 'ckfile' not in transferdict or \
+                    not hasattr(analyzerdict, 'keys') or \
+                    'warmstart' not in analyzerdict.keys():
+                return
+            transferdict = {'ckfile': transferdict.get('ckfile')}
         if 'xmlfiles' in transferdict:
-            files += sdpdata.xmlfilenames
+            files += [(file, self._isdelta(transferdict, 'xmlfiles'))
+                      for file in sdpdata.xmlfilenames]
         if 'outfile' in transferdict:
-            files += [sdpdata.outfile]
+            files += [(sdpdata.outfile, False)]
         if 'ckfile' in transferdict:
-            files += [sdpdata.checkpointfile]
+            files += [(sdpdata.checkpointfile,
+                       self._isdelta(transferdict, 'ckfile'))]
         if 'ckbkfile' in transferdict:
-            files += [sdpdata.backupcheckpointfile]
-        for file in files:
-            # We allow 'file' to contain a relative path.
-            destfile = destdir + file
-            self.copyfile(file, destfile, log)
+            # never in place: a checkpoint torn by an interrupted delta
+            # sync can always be recovered from the backup
+            files += [(sdpdata.backupcheckpointfile, False)]
+        # We allow 'file' to contain a relative path.
+        self.copyfiles([(file, destdir + file, delta)
+                        for file, delta in files], log)
 
-    def createSdpFiles(self, sdpdata, options=None):
+    @staticmethod
+    def _isdelta(transferdict, key):
+        # e.g. <ckfile>delta</ckfile>: only write the blocks that changed
+        return transferdict.get(key) == 'delta'
+
+    def sdpfilecache(self, sdpdata):
+        """
+        Only with <cernworld><sdpcache/></cernworld>, which may hold the
+        <directory> of the cache (by default in afsdir, where every hit is a
+        copy, as afs does not link across directories) and its <size> in
+        GiB.
+        """
+        cerndict = sdpdata.dict.get('cernworld')
+        if not hasattr(cerndict, 'keys') or 'sdpcache' not in cerndict.keys():
+            return None
+        cachedict = cerndict.get('sdpcache')
+        if not hasattr(cachedict, 'get'):
+            cachedict = {}
+        directory = cachedict.get('directory') or self.afsdir + 'sdpcache/'
+        size = cachedict.get('size')
+        size = self.sdpcachesize if size is None else float(size) * 2**30
+        return sdpcache.SdpFileCache(directory, size)
+
+    def getsdpfilecreator(self, sdpdata):
         cerndict = sdpdata.dict.get('cernworld')
         executabledict = cerndict.get('executables')
         if executabledict is not None:
             if 'sdpcreator' in executabledict:
-                self.sdpfilecreator = executabledict.get('sdpcreator')
+                return executabledict.get('sdpcreator')
+        return self.sdpfilecreator
+
+    def createSdpFiles(self, sdpdata, options=None):
         my_env = os.environ.copy()
         my_env["LD_LIBRARY_PATH"] = \
             self.libdir + ":" + my_env["LD_LIBRARY_PATH"]
-        return sp.run([self.sdpfilecreator, sdpdata.filename],
+        return sp.run([self.getsdpfilecreator(sdpdata), sdpdata.filename],
                       encoding='ascii', check=True, env=my_env)
 
     def runSdpb(self, sdpdata, options=None):
@@ -85,37 +151,43 @@ class CernWorld(manyworlds.World):
         my_env = os.environ.copy()
         my_env["LD_LIBRARY_PATH"] = \
             self.libdir + ":" + my_env["LD_LIBRARY_PATH"]
-        sp.run([self.sdpb] + sdpdata.sdpbargs,
-               stderr=sp.STDOUT,
-               check=True,         # i.e. raise an exception when sdpb fails
-               encoding='ascii',   # may need upgrading for sdpb-unicode
-               env=my_env)
-    # Code below should log sdpb output to the log file but maybe
-    # caused the "shadow exceptions" I experienced at the CERN cluster.
-    # with simplelogger.SimpleLogWriter('sdp', sdpdata.logfilename) as log:
-    #     my_env = os.environ.copy()
-    #     my_env["LD_LIBRARY_PATH"] = \
-    #         self.libdir + ":" + my_env["LD_LIBRARY_PATH"]
-    #     sdpbproc = sp.Popen([self.sdpb] + sdpdata.sdpbargs, stdout=sp.PIPE,
-    #                         stderr=sp.STDOUT, encoding='ascii', env=my_env)
-    #     for line in iter(sdpbproc.stdout.readline, ''):
-    #         log.write(line.rstrip())
+        # Streaming sdpb output through Popen was once suspected of causing
+        # the "shadow exceptions" seen at the CERN cluster; runstreaming keeps
+        # draining the pipe whatever goes wrong while logging.
+        return self.runstreaming([self.sdpb] + sdpdata.sdpbargs, sdpdata,
+                                 env=my_env)
 
-    def submit(self, sdpdata, options=None):
+    def _submissiondict(self, sdpdata, itemized=False):
+        """
+        The submit description for sdpdata. If itemized, the file-specific
+        entries refer to the item variables of submitmany instead.
+        """
+        if itemized:
+            filename = '$(sdpfile)'
+            condorlog = '$(condorlog)'
+            condorout = '$(condorout)'
+            condorerr = '$(condorerr)'
+        else:
+            filename = sdpdata.filename
+            condorlog = self._hide(sdpdata.filename + '.condorlog')
+            condorout = self._hide(sdpdata.filename + '.out')
+            condorerr = self._hide(sdpdata.filename + '.err')
         submissiondict = {#"executable": self.bindir + "worker.py",
                           #"arguments": "-w cern" + sdpdata.filename,
                           "executable": self.bindir + "clusterstarter.sh",
                           "arguments": self.bindir +
                           "worker.py -w cern " +
-                           sdpdata.filename,
-                          "log": self._hide(sdpdata.filename + '.condorlog'),
-                          "output": self._hide(sdpdata.filename + '.out'),
+                           filename,
+                          "log": condorlog,
+                          "output": condorout,
                           # str(sdpdata.numlogs()).zfill(3),
-                          "error": self._hide(sdpdata.filename + '.err')
+                          "error": condorerr
                           # str(sdpdata.numlogs()).zfill(3)}
                           }
         sdpdict = sdpdata.dict.get('cernworld').get('cluster')
         if sdpdict is not None:
+            # work on a copy: sdpdata may be shared through SdpDataFile.cached
+            sdpdict = dict(sdpdict)
             # add "+" because that's what htcondor can stomach
             if sdpdict.get('MaxRuntime'):
                 sdpdict['+MaxRuntime'] = sdpdict['MaxRuntime']
@@ -124,6 +196,11 @@ class CernWorld(manyworlds.World):
                 sdpdict['+JobFlavour'] = sdpdict['JobFlavour']
                 del sdpdict['JobFlavour']
             submissiondict.update(sdpdict)
+        return submissiondict
+
+    def submit(self, sdpdata, options=None):
+        import htcondor as htc
+        submissiondict = self._submissiondict(sdpdata)
         op = sp.check_output(['condor_submit', '-terse'],
                              input=str(htc.Submit(submissiondict)),
                              encoding='utf-8')
@@ -141,13 +218,104 @@ class CernWorld(manyworlds.World):
         # Interestingly, the problem disappears after using condor_submit once.
         # (perhaps an authentication error?)
 
+    def submitmany(self, sdpdatas, options=None):
+        """
+        Submit all files with a single condor_submit call per distinct
+        cluster setting, queueing one job per file from an item list.
+        Returns the job ids ('cluster.proc') in the order of sdpdatas. If a
+        condor_submit call fails, the CalledProcessError it raises carries
+        these ids as submissionids, with None for the jobs not queued.
+        """
+        import htcondor as htc
+        groups = {}
+        for i, sdpdata in enumerate(sdpdatas):
+            submissiondict = self._submissiondict(sdpdata, itemized=True)
+            key = tuple(sorted(submissiondict.items()))
+            groups.setdefault(key, []).append(i)
+        submissionids = [None] * len(sdpdatas)
+        for key, indices in groups.items():
+            items = []
+            for i in indices:
+                filename = sdpdatas[i].filename
+                items.append(' '.join([filename,
+                                       self._hide(filename + '.condorlog'),
+                                       self._hide(filename + '.out'),
+                                       self._hide(filename + '.err')]))
+            sub = htc.Submit(dict(key))
+            sub.setQArgs('sdpfile, condorlog, condorout, condorerr from (\n' +
+                         '\n'.join(items) + '\n)')
+            try:
+                op = sp.check_output(['condor_submit', '-terse'],
+                                     input=str(sub), encoding='utf-8')
+            except sp.CalledProcessError as e:
+                # the groups submitted before are queued all the same
+                e.submissionids = submissionids
+                raise
+            # expected output: XXXXX.Y - XXXXX.Z, one proc per item in order
+            cluster, firstproc = op.split()[0].split('.')
+            for n, i in enumerate(indices):
+                submissionids[i] = cluster + '.' + str(int(firstproc) + n)
+        return submissionids
+
+    @staticmethod
+    def _constraint(submissionid):
+        """
+        Query constraint for a submission id, which is either a cluster id
+        (from submit) or a 'cluster.proc' job id (from submitmany).
+        """
+        cluster, _, proc = submissionid.partition('.')
+        constraint = 'ClusterId =?= ' + cluster
+        if proc:
+            constraint += ' && ProcId =?= ' + proc
+        return constraint
+
+    def _getschedd(self):
+        if self.schedd is None:
+            import htcondor as htc
+            coll = htc.Collector()
+            self.schedd = htc.Schedd(coll.locate(htc.DaemonTypes.Schedd))
+        return self.schedd
+
+    def _query(self, constraint):
+        with self._lock:
+            return list(self._getschedd().xquery(
+                requirements=constraint,
+                projection=['ClusterId', 'ProcId', 'JobStatus', 'UserLog']))
+
+    def prefetch(self, submissionids):
+        """
+        Query the schedd once for all submissionids and keep the job ads for
+        the rest of the run, replacing those of an earlier prefetch.
+        """
+        submissionids = set(submissionids)
+        clusters = sorted({sid.partition('.')[0] for sid in submissionids})
+        jobads = {sid: [] for sid in submissionids}
+        if clusters:
+            ads = self._query('member(ClusterId, {' + ', '.join(clusters) +
+                              '})')
+            for ad in ads:
+                cluster = str(ad['ClusterId'])
+                for sid in (cluster, cluster + '.' + str(ad['ProcId'])):
+                    if sid in jobads:
+                        jobads[sid].append(ad)
+        with self._lock:
+            self.jobads = jobads
+
+    def _jobads(self, submissionid):
+        """
+        The job ads for a submission id, from the prefetched ones if possible.
+        """
+        with self._lock:
+            ads = self.jobads.get(submissionid)
+        if ads is None:
+            ads = self._query(self._constraint(submissionid))
+            with self._lock:
+                self.jobads[submissionid] = ads
+        return ads
+
     def getlogfilename(self, submissionid):
-        coll = htc.Collector()
-        schedd = htc.Schedd(coll.locate(htc.DaemonTypes.Schedd))
-        it = schedd.xquery(requirements='ClusterId =?= ' + submissionid,
-                           projection=['UserLog'])
         logfilename = None
-        for i in it:
+        for i in self._jobads(submissionid):
             logfilename = i['UserLog']
             assert(os.path.isfile(logfilename))
             break
@@ -157,12 +325,54 @@ class CernWorld(manyworlds.World):
         logfilename = self.getlogfilename(submissionid)
         if logfilename is not None:
             sp.run(['condor_wait', logfilename, submissionid])
+        # the job ads of this submission are outdated now
+        with self._lock:
+            self.jobads.pop(submissionid, None)
+
+    # user log events after which a job is gone: terminated, aborted
+    _endevent = re.compile(r'^00[59] \((\d+)\.(\d+)\.\d+\)', re.MULTILINE)
+
+    def _readuserlog(self, logfilename):
+        """
+        Read what was appended to a user log since the last call and remember
+        the jobs that ended there.
+        """
+        offset = self._logoffsets.get(logfilename, 0)
+        with open(logfilename, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # leave a partially written event for the next call
+        end = data.rfind(b'\n') + 1
+        self._logoffsets[logfilename] = offset + end
+        events = data[:end].decode(errors='replace')
+        for match in self._endevent.finditer(events):
+            cluster, proc = str(int(match.group(1))), str(int(match.group(2)))
+            self._endedjobs.update([cluster, cluster + '.' + proc])
+
+    def waitforany(self, submissionids, interval=10):
+        """
+        Wait for all submissions at once by following their user logs, and
+        return those whose jobs have ended as soon as there are any.
+        """
+        self.prefetch(submissionids)
+        logfilenames = {}
+        for submissionid in submissionids:
+            logfilenames[submissionid] = self.getlogfilename(submissionid)
+        while True:
+            for logfilename in set(logfilenames.values()) - {None}:
+                self._readuserlog(logfilename)
+            # jobs that left the queue have no user log to follow
+            done = [submissionid for submissionid in submissionids
+                    if logfilenames[submissionid] is None or
+                    submissionid in self._endedjobs]
+            if done:
+                with self._lock:
+                    for submissionid in done:
+                        self.jobads.pop(submissionid, None)
+                return done
+            time.sleep(interval)
 
     def isreallyrunning(self, submissionid):
-        coll = htc.Collector()
-        schedd = htc.Schedd(coll.locate(htc.DaemonTypes.Schedd))
-        it = schedd.xquery(requirements='ClusterId =?= ' + submissionid,
-                           projection=['JobStatus'])
         # 0	Unexpanded
         # 1	Idle
         # 2	Running
@@ -170,7 +380,7 @@ class CernWorld(manyworlds.World):
         # 4	Completed
         # 5	Held
         # 6	Submission_err
-        for i in it:
+        for i in self._jobads(submissionid):
             if i['JobStatus'] == 1 or i['JobStatus'] == 2:
                 return True
         return False
@@ -1,23 +1,40 @@
 #!/usr/bin/env python3
 
 import argparse
-import datetime
+import analyzer
 import sdpdatafile
 import simplelogger
-import analyzer
+import campaign
+import deltasync
 import os.path
 import sys
 import manyworlds
-import subprocess as sp
-# from multiprocessing.dummy import Pool as ThreadPool
+from multiprocessing.dummy import Pool as ThreadPool
 
-parser = argparse.ArgumentParser()
-parser.add_argument('filenames', metavar='fn', nargs='+',
+parser = argparse.ArgumentParser(
+    description="""Remove everything that the superseded steps of 'replaced
+                   with' chains left behind: the sdp data files and their
+                   logs, the generated sdp files, out files, checkpoints and
+                   the files of the world. The heads of the chains, and
+                   everything they refer to, are kept. Relative paths in an
+                   sdp data file are taken relative to its directory.""")
+parser.add_argument('filenames', metavar='fn', nargs='*',
                     help="""A number of sdp data files to potentially clean up.""")
 parser.add_argument('-w', '--world', choices=['local', 'cern', 'fake'],
                     help="""Select the local environment.""")
+parser.add_argument('-M', '--manifest',
+                    help="""A campaign manifest. Its files are cleaned up
+                            (besides the given files), and the removed ones
+                            are removed from it.""")
+parser.add_argument('-n', '--dryrun', action='store_true',
+                    help="""Only report what would be removed, and its
+                            size.""")
+parser.add_argument('-j', '--jobs', type=int, default=8,
+                    help="""Number of files to remove in parallel.""")
 
 args = parser.parse_args()
+if not args.filenames and args.manifest is None:
+    parser.error('no sdp data files or manifest given')
 sdpDataFilenames = args.filenames
 if not all(map(os.path.isfile, sdpDataFilenames)):
     print('Could not find sdp data file(s)', file=sys.stderr)
@@ -25,25 +42,148 @@ if not all(map(os.path.isfile, sdpDataFilenames)):
 sdpDataFilenames = list(map(os.path.abspath, sdpDataFilenames))
 world = manyworlds.getworld(args.world)
 
-def inlineprint(expr):
-    print(expr, end=' ', flush=True)
 
-def cleanup(filename):
-    sdpdata = sdpdatafile.SdpDataFile(filename)
+def replacementgraph(filenames):
+    """
+    Follow the 'replaced with' entries from the files, reading every log
+    once. Returns the replacements of every file found, and the files that
+    are superseded: concluded and replaced, or concluded trials of a
+    k-section round that one of its trials continued in a next round.
+    """
+    replacements = {}
+    superseded = []
+    concluded = []
+    tovisit = list(filenames)
+    while tovisit:
+        filename = tovisit.pop()
+        if filename in replacements or not os.path.isfile(filename):
+            continue
+        log = simplelogger.LogState.get(filename + '.log')
+        replacements[filename] = [os.path.abspath(newfilename)
+                                  for newfilename in log.replacements]
+        if log.status == 'concluded':
+            if replacements[filename]:
+                superseded.append(filename)
+            else:
+                concluded.append(filename)
+        tovisit += replacements[filename]
+    continued = {analyzer.roundfilename(filename) for filename in superseded
+                 if istrial(filename)}
+    superseded += [filename for filename in concluded
+                   if istrial(filename) and
+                   analyzer.roundfilename(filename) in continued]
+    return replacements, superseded
+
+
+def istrial(filename):
+    analyzerdict = sdpdatafile.SdpDataFile.cached(filename).dict.get(
+        'analyzer')
+    return hasattr(analyzerdict, 'get') and \
+        analyzerdict.get('trial') is not None
+
+
+def artifacts(filename):
+    """
+    The files belonging to the step in filename, by kind.
+    """
+    sdpdata = sdpdatafile.SdpDataFile.cached(filename)
+    directory = os.path.dirname(filename)
+
+    def paths(files):
+        return [os.path.abspath(os.path.join(directory, file))
+                for file in files if file is not None]
+
+    checkpoints = [sdpdata.checkpointfile, sdpdata.backupcheckpointfile]
+    return {'sdp data file': [filename],
+            'log': [sdpdata.logfilename, sdpdata.logfilename + '.gz'],
+            'sdp file': paths(sdpdata.xmlfilenames),
+            'out file': paths([sdpdata.outfile]),
+            'checkpoint': paths(checkpoints) +
+            paths([deltasync.signaturefilename(ckfile)
+                   for ckfile in checkpoints if ckfile is not None]),
+            'world': paths(world.artifacts(sdpdata)),
+            'marker': [analyzer.claimfilename(analyzer.roundfilename(
+                filename))] if istrial(filename) else []}
+
+
+def referenced(filename):
+    """
+    The files that the step in filename needs, including the checkpoint
+    it warm starts from.
+    """
+    sdpdata = sdpdatafile.SdpDataFile.cached(filename)
+    files = set(sum(artifacts(filename).values(), []))
+    if sdpdata.warmstartfile is not None:
+        warmstartfile = os.path.abspath(
+            os.path.join(os.path.dirname(filename), sdpdata.warmstartfile))
+        files |= {warmstartfile, warmstartfile + '.bk'}
+    return files
+
+
+def plan(filenames):
+    """
+    The existing files to remove, with their kind and size, and the
+    superseded steps they belong to.
+    """
+    replacements, superseded = replacementgraph(filenames)
+    keep = set()
+    for filename in replacements:
+        if filename not in superseded:
+            keep |= referenced(filename)
+    toremove = {}
+    for filename in superseded:
+        for kind, files in artifacts(filename).items():
+            for file in files:
+                if file not in keep and file not in toremove and \
+                        os.path.isfile(file):
+                    toremove[file] = (kind, os.path.getsize(file))
+    return toremove, superseded
+
+
+def remove(file):
+    try:
+        os.remove(file)
+        return True
+    except FileNotFoundError:
+        return False
+
 
-    log = simplelogger.SimpleLogReader(sdpdata.logfilename)
+def report(toremove, removed=None):
+    sizes = {}
+    for file, (kind, size) in toremove.items():
+        if removed is None or removed.get(file):
+            count, total = sizes.get(kind, (0, 0))
+            sizes[kind] = (count + 1, total + size)
+    for kind, (count, total) in sorted(sizes.items()):
+        print('{:<16}{:>8} files {:>12.1f} MB'.format(kind, count,
+                                                      total / 2**20))
+    count = sum(count for count, _ in sizes.values())
+    total = sum(total for _, total in sizes.values())
+    print(('Would remove ' if removed is None else 'Removed ') +
+          str(count) + ' files, ' + '{:.1f}'.format(total / 2**20) + ' MB.')
 
-    if log.getstatus() == 'concluded':
-        newfilename = log.lastbonusexprwith(expr='replaced with')
-        if newfilename is not None:
-            world.removefile(filename)
-            world.removefile(sdpdata.logfilename)
 
-# Parallel version:
-# pool = ThreadPool(len(sdpDataFilenames))
-# results = pool.map(handle, sdpDataFilenames)
-# pool.close()
-# pool.join()
+filenames = list(sdpDataFilenames)
+if args.manifest is not None:
+    manifest = campaign.Manifest(args.manifest)
+    try:
+        manifest.load()
+    except ValueError as e:
+        parser.error(str(e))
+    filenames += list(manifest.entries)
 
-for sdpDataFilename in sdpDataFilenames:
-    cleanup(sdpDataFilename)
+toremove, superseded = plan(filenames)
+if args.dryrun:
+    report(toremove)
+else:
+    files = list(toremove)
+    pool = ThreadPool(max(1, args.jobs))
+    removed = dict(zip(files, pool.map(remove, files, chunksize=64)))
+    pool.close()
+    pool.join()
+    report(toremove, removed)
+    if args.manifest is not None:
+        with campaign.Manifest(args.manifest).locked() as manifest:
+            for filename in superseded:
+                if not os.path.isfile(filename):
+                    manifest.remove(filename)
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import shutil
+
+# bytes per block that is compared and, if changed, transferred
+blocksize = 2**20
+
+
+def _digest(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def signaturefilename(filename):
+    """
+    The hidden sidecar next to filename that holds its block hashes.
+    """
+    path, file = os.path.split(filename)
+    return os.path.join(path, '.' + file + '.sig')
+
+
+def signature(filename, blocksize=blocksize):
+    with open(filename, 'rb') as f:
+        return [_digest(block)
+                for block in iter(lambda: f.read(blocksize), b'')]
+
+
+def readsignature(filename, blocksize=blocksize):
+    """
+    The block hashes of filename according to its sidecar, or None if there
+    is no sidecar or it does not describe the file as it is now.
+    """
+    try:
+        with open(signaturefilename(filename)) as f:
+            header = f.readline().split()
+            digests = f.read().split()
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    if header != [str(blocksize), str(st.st_size), str(st.st_mtime_ns)]:
+        return None
+    return digests
+
+
+def writesignature(filename, digests, blocksize=blocksize):
+    st = os.stat(filename)
+    sigfilename = signaturefilename(filename)
+    with open(sigfilename + '.tmp', 'w') as f:
+        f.write(' '.join([str(blocksize), str(st.st_size),
+                          str(st.st_mtime_ns)]) + '\n')
+        f.write('\n'.join(digests) + '\n')
+    os.replace(sigfilename + '.tmp', sigfilename)
+
+
+def sync(origfile, dest, blocksize=blocksize):
+    """
+    Make dest a copy of origfile by writing only the blocks that differ.
+    The block hashes of dest are taken from its sidecar if that is up to
+    date, so that dest does not even have to be read, and the sidecar is
+    updated afterwards. Returns the number of bytes written.
+
+    Blocks are compared at the same offsets only; there is no rolling
+    checksum to find shifted content. Consecutive checkpoints of an sdpb run
+    have the same layout, so this catches what is unchanged between them.
+    Unlike World.copyfile, dest is updated in place, so an interrupted sync
+    leaves it as a mix of old and new blocks. The sidecar is removed before
+    the first write and only written again at the end: a dest without one
+    may be torn, and is hashed in full by the next sync.
+    """
+    if os.path.isfile(dest):
+        destdigests = readsignature(dest, blocksize)
+        if destdigests is None:
+            destdigests = signature(dest, blocksize)
+    else:
+        open(dest, 'wb').close()
+        destdigests = []
+    try:
+        os.remove(signaturefilename(dest))
+    except FileNotFoundError:
+        pass
+    digests = []
+    written = 0
+    with open(origfile, 'rb') as orig, open(dest, 'r+b') as out:
+        for i, block in enumerate(iter(lambda: orig.read(blocksize), b'')):
+            digest = _digest(block)
+            digests.append(digest)
+            if i >= len(destdigests) or destdigests[i] != digest:
+                out.seek(i * blocksize)
+                out.write(block)
+                written += len(block)
+        out.truncate(orig.tell())
+    shutil.copystat(origfile, dest)
+    writesignature(dest, digests, blocksize)
+    return written
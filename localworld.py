@@ -1,7 +1,12 @@
+#!/usr/bin/env python3
 import subprocess as sp
 import manyworlds
 import psutil
 import time
+import os
+import sys
+import fcntl
+import argparse
 
 
 class LocalWorld(manyworlds.World):
@@ -9,19 +14,259 @@ class LocalWorld(manyworlds.World):
     #                  'MathematicaScript -file ../mathematica/nbevaluator.m'
     sdpfilecreator = '/Users/vanrees/.local/bin/qftinads-exe'
     sdpb = '/Users/vanrees/.local/bin/sdpb'
+    worker = '/Users/vanrees/.local/bin/worker.py'
+    # jobs are queued here and started by a LocalScheduler process
+    queuedir = os.path.expanduser('~/.sdpmanager/queue')
+    # set SDPMANAGER_SDPCACHE to a directory to cache the sdp files there
+    sdpcachedir = os.environ.get('SDPMANAGER_SDPCACHE')
+    # number of threads that the scheduler keeps busy at most; set
+    # SDPMANAGER_SLOTS when submitting to change it, also for a scheduler
+    # that is running already
+    slots = int(os.environ.get('SDPMANAGER_SLOTS') or os.cpu_count())
 
     def submit(self, sdpdata, options=None):
-        # execute in background
-        process = sp.Popen(['/Users/vanrees/.local/bin/worker.py',
-                            '-w', 'local', sdpdata.filename])
-        pid = str(process.pid)
-        return pid
+        return self.submitmany([sdpdata], options)[0]
+
+    def submitmany(self, sdpdatas, options=None):
+        """
+        Queue the files and make sure a scheduler is working off the queue.
+        Returns the ids of the queue entries.
+        """
+        queue = LocalQueue(self.queuedir)
+        if os.environ.get('SDPMANAGER_SLOTS'):
+            queue.setslots(self.slots)
+        submissionids = [queue.put(sdpdata.filename, self.threads(sdpdata))
+                         for sdpdata in sdpdatas]
+        self.startscheduler()
+        return submissionids
+
+    @staticmethod
+    def threads(sdpdata):
+        """
+        The number of threads a job uses, according to the maxThreads
+        setting in its sdpbParams.
+        """
+        sdpbdict = sdpdata.dict.get('sdpbData')
+        if hasattr(sdpbdict, 'get') and hasattr(sdpbdict.get('params'), 'get'):
+            try:
+                return max(1, int(sdpbdict.get('params').get('maxThreads')))
+            except (TypeError, ValueError):
+                pass
+        return 1
+
+    def startscheduler(self):
+        if LocalScheduler.isrunning(self.queuedir):
+            return
+        with open(os.path.join(self.queuedir, 'scheduler.out'), 'a') as out:
+            sp.Popen([sys.executable, os.path.abspath(__file__),
+                      '--queuedir', self.queuedir,
+                      '--slots', str(self.slots),
+                      '--worker', self.worker],
+                     stdin=sp.DEVNULL, stdout=out, stderr=sp.STDOUT,
+                     start_new_session=True)
 
     def isreallyrunning(self, submissionid):
-        return psutil.pid_exists(int(submissionid))
+        if submissionid.isdigit():
+            # submitted before there was a queue: a process id
+            return psutil.pid_exists(int(submissionid))
+        state, pid = LocalQueue(self.queuedir).state(submissionid)
+        if state == 'queued':
+            return True
+        elif state == 'running':
+            # no pid means the scheduler is just starting it
+            return pid is None or psutil.pid_exists(pid)
+        return False
 
     def waitforcompletion(self, submissionid):
-        while psutil.pid_exists(int(submissionid)):
+        while self.isreallyrunning(submissionid):
+            # necessary to avoid zombie status
+            sp._cleanup()
+            time.sleep(1)
+
+    def waitforany(self, submissionids):
+        while True:
             # necessary to avoid zombie status
             sp._cleanup()
+            done = [submissionid for submissionid in submissionids
+                    if not self.isreallyrunning(submissionid)]
+            if done:
+                return done
             time.sleep(1)
+
+
+class LocalQueue:
+    """
+    A persistent job queue in a directory. Each job is a small file
+    holding its sdp data file, its number of threads and the directory it
+    was submitted from. It is called <id>.queued while waiting, renamed to
+    <id>.running when started (with the pid added) and removed when done.
+    The file 'slots' may hold the number of slots for the scheduler.
+    """
+
+    def __init__(self, queuedir):
+        self.queuedir = queuedir
+        os.makedirs(queuedir, exist_ok=True)
+
+    def _path(self, submissionid, state):
+        return os.path.join(self.queuedir, submissionid + '.' + state)
+
+    def put(self, filename, threads):
+        # ids sort in order of submission
+        submissionid = 'q' + str(time.time_ns()) + '-' + str(os.getpid())
+        tmpfile = self._path(submissionid, 'tmp')
+        with open(tmpfile, 'w') as f:
+            f.write('\n'.join([filename, str(threads), os.getcwd()]) + '\n')
+        os.replace(tmpfile, self._path(submissionid, 'queued'))
+        return submissionid
+
+    def queued(self):
+        return sorted(entry[:-len('.queued')]
+                      for entry in os.listdir(self.queuedir)
+                      if entry.endswith('.queued'))
+
+    def running(self):
+        return sorted(entry[:-len('.running')]
+                      for entry in os.listdir(self.queuedir)
+                      if entry.endswith('.running'))
+
+    def read(self, submissionid, state):
+        """
+        Returns filename, threads, directory and pid (or None) of a job.
+        """
+        with open(self._path(submissionid, state)) as f:
+            fields = f.read().split('\n')
+        pid = int(fields[3]) if len(fields) > 4 else None
+        return fields[0], int(fields[1]), fields[2], pid
+
+    def state(self, submissionid):
+        """
+        Returns 'queued', 'running' or None, and the pid if running.
+        """
+        for state in ['queued', 'running']:
+            try:
+                return state, self.read(submissionid, state)[3]
+            except FileNotFoundError:
+                pass
+        return None, None
+
+    def start(self, submissionid):
+        os.replace(self._path(submissionid, 'queued'),
+                   self._path(submissionid, 'running'))
+
+    def setpid(self, submissionid, pid):
+        with open(self._path(submissionid, 'running'), 'a') as f:
+            f.write(str(pid) + '\n')
+
+    def done(self, submissionid):
+        os.remove(self._path(submissionid, 'running'))
+
+    def slots(self, default):
+        try:
+            with open(os.path.join(self.queuedir, 'slots')) as f:
+                return max(1, int(f.read()))
+        except (FileNotFoundError, ValueError):
+            return default
+
+    def setslots(self, slots):
+        tmpfile = os.path.join(self.queuedir, 'slots.tmp' + str(os.getpid()))
+        with open(tmpfile, 'w') as f:
+            f.write(str(slots) + '\n')
+        os.replace(tmpfile, os.path.join(self.queuedir, 'slots'))
+
+
+class LocalScheduler:
+    """
+    Works off a LocalQueue: starts the oldest queued job as soon as enough
+    slots are free for its threads, and exits when the queue is empty and
+    all its jobs have finished. Only one scheduler runs per queue. The
+    number of slots in the queue, if set, overrides slots, and is read
+    again before starting jobs.
+    """
+
+    def __init__(self, queuedir, slots, worker):
+        self.queue = LocalQueue(queuedir)
+        self.lockfilename = os.path.join(queuedir, 'scheduler.lock')
+        self.defaultslots = slots
+        self.slots = slots
+        self.worker = worker
+        # processes and threads of the jobs we started
+        self.jobs = {}
+
+    @staticmethod
+    def isrunning(queuedir):
+        with open(os.path.join(queuedir, 'scheduler.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            return False
+
+    def run(self):
+        with open(self.lockfilename, 'a') as lock:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # another scheduler is at work
+                    return
+                self._forgetorphans()
+                while self.jobs or self.queue.queued():
+                    self._reap()
+                    self._startjobs()
+                    time.sleep(1)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                # a job may have been queued just before we let go
+                if not self.queue.queued():
+                    return
+
+    def _forgetorphans(self):
+        # running jobs of a scheduler that died are not ours to count
+        for submissionid in self.queue.running():
+            if submissionid not in self.jobs:
+                pid = self.queue.read(submissionid, 'running')[3]
+                if pid is None or not psutil.pid_exists(pid):
+                    self.queue.done(submissionid)
+
+    def _reap(self):
+        for submissionid, (process, threads) in list(self.jobs.items()):
+            if process.poll() is not None:
+                self.queue.done(submissionid)
+                del self.jobs[submissionid]
+
+    def _startjobs(self):
+        self.slots = self.queue.slots(self.defaultslots)
+        free = self.slots - sum(threads for _, threads in self.jobs.values())
+        for submissionid in self.queue.queued():
+            filename, threads, cwd, _ = self.queue.read(submissionid,
+                                                        'queued')
+            # a job that is too big for this machine runs on its own
+            threads = min(threads, self.slots)
+            if threads > free:
+                # first come, first served
+                break
+            self.queue.start(submissionid)
+            process = sp.Popen([self.worker, '-w', 'local', filename],
+                               cwd=cwd)
+            self.queue.setpid(submissionid, process.pid)
+            self.jobs[submissionid] = (process, threads)
+            free -= threads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run the scheduler of the local world in the foreground.')
+    parser.add_argument('--queuedir', default=LocalWorld.queuedir,
+                        help='the queue to work off')
+    parser.add_argument('--slots', type=int, default=LocalWorld.slots,
+                        help='the number of threads to keep busy at most')
+    parser.add_argument('--worker', default=LocalWorld.worker,
+                        help='the worker executable')
+    parser.add_argument('--setslots', type=int,
+                        help="""set the number of slots in the queue, also
+                                for a running scheduler, and exit""")
+    args = parser.parse_args()
+    if args.setslots is not None:
+        LocalQueue(args.queuedir).setslots(args.setslots)
+    else:
+        LocalScheduler(args.queuedir, args.slots, args.worker).run()
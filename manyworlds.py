@@ -1,6 +1,14 @@
 import subprocess as sp
+import filecmp
 import os
 import shutil
+import sys
+import threading
+import time
+import simplelogger
+import sdpcache
+import deltasync
+from multiprocessing.dummy import Pool as ThreadPool
 
 
 class World:
@@ -8,11 +16,15 @@ class World:
     Template class for a world (a cluster) providing methods for:
     - submitting and managing jobs:
         - submit
+        - submitmany (which submits many files at once, if the world can)
+        - prefetch (which may look up many submissions at once)
         - isreallyrunning (which is supposed to check in with the cluster)
         - waitforcompletion (which is supposed to check in with the cluster)
+        - waitforany (which waits for whichever job completes first)
+        - artifacts (the files a job leaves behind)
     - running a job on a node:
         - warmup
-        - createSdpFiles
+        - createSdpFiles (cached in sdpfilecache, if any)
         - runSdpb
         - cooldown
     In a barebones world it suffices to set the three executables below.
@@ -20,30 +32,160 @@ class World:
     sdpfilecreator = 'echo'
     sdpb = 'echo'
     submitter = 'echo'
+    # seconds between two progress records of sdpb in the job log
+    progressinterval = 60
+    # where generated sdp files are cached (None for no cache, the default),
+    # and how many bytes the cache may hold
+    sdpcachedir = None
+    sdpcachesize = 2 * 2**30
+    # number of files that copyfiles transfers at the same time
+    transferthreads = 4
 
     def submit(self, sdpdata, options=None):
         return sp.run([self.submitter, sdpdata.filename], stderr=sp.PIPE,
                       encoding='ascii', check=True)
 
+    def submitmany(self, sdpdatas, options=None):
+        """
+        Submit several files and return their submission ids in order.
+        Worlds that can submit in bulk should override this.
+        """
+        return [self.submit(sdpdata, options) for sdpdata in sdpdatas]
+
+    def prefetch(self, submissionids):
+        """
+        Called with all submission ids that isreallyrunning or
+        waitforcompletion may be asked about, so that a world can look them
+        up in one go.
+        """
+        pass
+
     def isreallyrunning(self, submissionid):
         pass
 
     def waitforcompletion(self, submissionid):
         pass
 
+    def waitforany(self, submissionids):
+        """
+        Wait until at least one of the submissions has completed and return
+        the ones that have. Worlds that can watch many jobs at once should
+        override this; by default we just wait for the first one.
+        """
+        self.waitforcompletion(submissionids[0])
+        return submissionids[:1]
+
+    def artifacts(self, sdpdata):
+        """
+        The files that a job leaves behind in this world besides the ones
+        named in its sdp data file, such as cluster logs. Used by cleanup.
+        """
+        return []
+
     def warmup(self, sdpdata, log=None):
         pass
 
     def cooldown(self, sdpdata, tr, log=None):
         pass
 
+    def sdpfilecache(self, sdpdata):
+        """
+        The cache for the sdp files of sdpdata, or None if they are not
+        cached.
+        """
+        if self.sdpcachedir is not None:
+            return sdpcache.SdpFileCache(self.sdpcachedir, self.sdpcachesize)
+
+    def getsdpfilecreator(self, sdpdata):
+        """
+        The creator that createSdpFiles runs for sdpdata.
+        """
+        return self.sdpfilecreator
+
     def createSdpFiles(self, sdpdata, options=None):
-        return sp.run(self.sdpfilecreator + ' ' + sdpdata.filename,
+        creator = self.getsdpfilecreator(sdpdata)
+        return sp.run(creator + ' ' + sdpdata.filename,
                       encoding='ascii', check=True, shell=True)
 
     def runSdpb(self, sdpdata, options=None):
-        return sp.run([self.sdpb] + sdpdata.sdpbargs,
-                      encoding='ascii', check=True)
+        return self.runstreaming([self.sdpb] + sdpdata.sdpbargs, sdpdata)
+
+    def runstreaming(self, args, sdpdata, env=None):
+        """
+        Run sdpb like sp.run(args, check=True), passing its output on to our
+        stdout. Meanwhile a background thread parses the iterations and
+        writes progress records to the job log, at most one per
+        progressinterval seconds plus the last iteration.
+        """
+        process = sp.Popen(args, stdout=sp.PIPE, stderr=sp.STDOUT, env=env)
+        follower = threading.Thread(target=self._followprogress,
+                                    args=(process.stdout, sdpdata.logfilename),
+                                    daemon=True)
+        follower.start()
+        returncode = process.wait()
+        follower.join()
+        if returncode != 0:
+            raise sp.CalledProcessError(returncode, args)
+        return sp.CompletedProcess(args, returncode)
+
+    def _followprogress(self, stream, logfilename):
+        # Nothing that goes wrong here may stop us from draining the pipe,
+        # or sdpb would block on a full pipe.
+        try:
+            log = simplelogger.SimpleLogWriter('sdp', logfilename)
+        except Exception:
+            # forward the output all the same, without logging progress
+            log = None
+        columns = None
+        progress = None
+        lastwrite = None
+        for rawline in iter(stream.readline, b''):
+            try:
+                line = rawline.decode(errors='replace')
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                columns, iteration = self.parseprogress(line, columns)
+                if iteration is not None and log is not None:
+                    progress = iteration
+                    now = time.monotonic()
+                    if lastwrite is None or \
+                            now - lastwrite >= self.progressinterval:
+                        log.write('progress', progress)
+                        progress = None
+                        lastwrite = now
+            except Exception:
+                pass
+        stream.close()
+        if progress is not None:
+            try:
+                log.write('progress', progress)
+            except Exception:
+                pass
+
+    # columns of the sdpb iteration table that end up in the log
+    progresscolumns = ['time', 'mu', 'P-obj', 'D-obj', 'gap',
+                       'P-err', 'D-err', 'P-step', 'D-step']
+
+    @classmethod
+    def parseprogress(cls, line, columns=None):
+        """
+        Parse a line of sdpb output, given the column names of the last
+        table header seen. Returns the (possibly new) column names, and a
+        progress record if the line is an iteration.
+        """
+        fields = line.split()
+        if 'mu' in fields and 'P-obj' in fields:
+            # table header; the iteration number has no column name
+            return fields, None
+        if columns is None or not fields or not fields[0].isdigit() or \
+                len(fields) < len(cls.progresscolumns):
+            return columns, None
+        values = dict(zip(columns, fields[1:]))
+        iteration = 'iteration=' + fields[0]
+        for column in cls.progresscolumns:
+            if column in values:
+                iteration += ' ' + column + '=' + values[column]
+        return columns, iteration
 
     @staticmethod
     def checkorcreatedir(dest, log=None):
@@ -75,11 +217,20 @@ class World:
             print(logmsg)
 
     @staticmethod
-    def copyfile(origfile, dest, log=None):
+    def copyfile(origfile, dest, log=None, delta=False):
         """
         Copy a file to dest, which can be either a file or a directory.
+        With delta, only the blocks that changed are written (see deltasync).
         """
-        if os.path.isfile(origfile):
+        if os.path.isfile(origfile) and delta:
+            World.checkorcreatedir(dest, log)
+            if os.path.isdir(dest):
+                dest = os.path.join(dest, os.path.basename(origfile))
+            written = deltasync.sync(origfile, dest)
+            logmsg = 'Synced ' + origfile + ' to ' + dest + ' (' + \
+                str(written) + ' of ' + str(os.path.getsize(dest)) + \
+                ' bytes written).'
+        elif os.path.isfile(origfile):
             World.checkorcreatedir(dest, log)
             shutil.copy(origfile, dest)
             logmsg = 'Copied ' + origfile + ' to ' + dest + '.'
@@ -90,6 +241,83 @@ class World:
         else:
             print(logmsg)
 
+    @classmethod
+    def copyfiles(cls, pairs, log=None, threads=None):
+        """
+        Copy many (origfile, dest) pairs at once on a pool of threads, like
+        copyfile. A destination that already has the same size and mtime,
+        or the same content, is left alone. Each copy goes to a temporary
+        file first and is renamed into place, so dest is never partial.
+        A pair may have a third element delta, to sync the file as in
+        copyfile instead.
+        Everything is logged from the calling thread, in the order of pairs.
+        """
+        pairs = list(pairs)
+        if threads is None:
+            threads = cls.transferthreads
+        pool = ThreadPool(max(1, min(threads, len(pairs))))
+        try:
+            logmsgs = pool.starmap(cls._transfer, pairs)
+        finally:
+            pool.close()
+            pool.join()
+        for logmsg in logmsgs:
+            if log is not None:
+                log.write(logmsg)
+            else:
+                print(logmsg)
+
+    @staticmethod
+    def _transfer(origfile, dest, delta=False):
+        if not os.path.isfile(origfile):
+            return 'Could not find ' + origfile + ' to copy.'
+        if os.path.dirname(dest) != '':
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(origfile))
+        # a delta sync compares the content anyway
+        if World._uptodate(origfile, dest, comparecontent=not delta):
+            return 'Skipped ' + origfile + ': ' + dest + ' is up to date.'
+        start = time.time()
+        if delta:
+            written = deltasync.sync(origfile, dest)
+            return 'Synced ' + origfile + ' to ' + dest + ' (' + \
+                str(written) + ' of ' + str(os.path.getsize(dest)) + \
+                ' bytes written in ' + \
+                '{:.2f}'.format(time.time() - start) + ' s).'
+        destdir, destfile = os.path.split(dest)
+        tmpfile = os.path.join(destdir, '.' + destfile + '.tmp' +
+                               str(os.getpid()) + '-' +
+                               str(threading.get_ident()))
+        try:
+            shutil.copyfile(origfile, tmpfile)
+            shutil.copystat(origfile, tmpfile)
+            os.replace(tmpfile, dest)
+        finally:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+        size = os.path.getsize(dest)
+        return 'Copied ' + origfile + ' to ' + dest + ' (' + str(size) + \
+            ' bytes in ' + '{:.2f}'.format(time.time() - start) + ' s).'
+
+    @staticmethod
+    def _uptodate(origfile, dest, comparecontent=True):
+        try:
+            destst = os.stat(dest)
+        except FileNotFoundError:
+            return False
+        origst = os.stat(origfile)
+        if origst.st_size != destst.st_size:
+            return False
+        if origst.st_mtime_ns == destst.st_mtime_ns:
+            return True
+        # same size but touched: compare the content, which only reads
+        if comparecontent and filecmp.cmp(origfile, dest, shallow=False):
+            # so that the mtime suffices next time
+            shutil.copystat(origfile, dest)
+            return True
+        return False
+
     @staticmethod
     def removefile(origfile, log=None):
         if os.path.isfile(origfile):
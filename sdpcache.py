@@ -0,0 +1,135 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+
+class SdpFileCache:
+    """
+    Content-addressed cache for the sdp input files that a creator
+    generates from the <sdpFileData> blocks of a data file.
+
+    An entry is keyed by a hash of those blocks (without their <filename>,
+    which only says where the result goes) and of the creator executable.
+    It is a directory holding the generated files in the order of
+    sdpdata.xmlfilenames. Hits are linked or copied into place, and the
+    least recently used entries are evicted once the cache grows beyond
+    maxsize bytes. Eviction walks the whole cache, so stores only evict
+    once every evictinterval seconds, and the cache may outgrow maxsize by
+    what is stored meanwhile.
+    """
+
+    evictinterval = 600
+
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(sdpdata, creator):
+        """
+        The cache key of the files that creator makes for sdpdata.
+        """
+        blocks = []
+        for element in sdpdata.sdpfiledata:
+            element = copy.deepcopy(element)
+            for filename in element.findall('filename'):
+                element.remove(filename)
+            blocks.append(ET.canonicalize(ET.tostring(element, 'unicode'),
+                                          strip_text=True))
+        # a rebuilt creator may create different files
+        creatorstat = None
+        executable = shutil.which(creator.split()[0]) if creator else None
+        if executable is not None:
+            st = os.stat(executable)
+            creatorstat = [st.st_size, st.st_mtime_ns]
+        content = json.dumps([creator, creatorstat, blocks])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, key, filenames):
+        """
+        Put the cached files of key in place. Returns whether there were
+        any.
+        """
+        entry = self._entry(key)
+        cached = [os.path.join(entry, str(i)) for i in range(len(filenames))]
+        if not all(map(os.path.isfile, cached)):
+            return False
+        for cachedfile, filename in zip(cached, filenames):
+            self._place(cachedfile, filename)
+        # mark as recently used
+        os.utime(entry)
+        return True
+
+    @staticmethod
+    def _place(origfile, dest):
+        # replace atomically, so nobody sees a partial file
+        tmpfile = dest + '.cachetmp'
+        try:
+            os.link(origfile, tmpfile)
+        except OSError:
+            # e.g. another file system or afs, which only links within a dir
+            shutil.copyfile(origfile, tmpfile)
+        os.replace(tmpfile, dest)
+
+    def store(self, key, filenames):
+        """
+        Add freshly created files to the cache under key.
+        """
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        tmpentry = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        try:
+            for i, filename in enumerate(filenames):
+                shutil.copyfile(filename, os.path.join(tmpentry, str(i)))
+            os.rename(tmpentry, entry)
+        except OSError:
+            # most likely someone else stored the same entry meanwhile
+            shutil.rmtree(tmpentry, ignore_errors=True)
+        if self._evictiondue():
+            self.evict()
+
+    def _evictiondue(self):
+        """
+        Whether the last eviction (by anyone) is longer than evictinterval
+        ago. If so, the next one starts now.
+        """
+        marker = os.path.join(self.directory, '.evicted')
+        try:
+            if time.time() - os.path.getmtime(marker) < self.evictinterval:
+                return False
+        except FileNotFoundError:
+            pass
+        open(marker, 'a').close()
+        os.utime(marker)
+        return True
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            entry = self._entry(name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                           for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except FileNotFoundError:
+                # evicted by someone else
+                continue
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.maxsize:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -1,7 +1,14 @@
+import contextlib
+import copy
 import os.path
+import shutil
+import threading
 import xml.etree.ElementTree as ET
 # import simplelogger
 
+# marks lazily computed attributes that may legitimately be None
+_unset = object()
+
 
 class SdpDataFile:
     """ Main class for a single sdpb optimization.
@@ -19,25 +26,107 @@ class SdpDataFile:
         - then adds the content of the leaf <filename> inside any <sdpFileData>
           tags source files for sdpb, provided <autosdpFiles /> is set.
     - other strings for input sdpb xml files, checkpoint and output files, etc.
+    - sdpfiledata, the <sdpFileData> elements from which the sdp input files
+      are created
+    - warmstartfile, the content of the leaf <warmstart> inside <sdpbData>: a
+      checkpoint to start from when there is no checkpoint of our own yet
     - simple locking/islocked/unlock functionality
+
+    The xml file is parsed at most once, on first use of any of the above.
+    SdpDataFile.cached additionally shares instances across a process for
+    as long as the file does not change.
     """
 
+    __slots__ = ('filename', 'logfilename', '_stamp', '_rootel',
+                 '_xmlfilenames', '_sdpbargs', '_outfile', '_checkpointfile',
+                 '_warmstartfile', '_dict')
+
+    # process-wide cache used by SdpDataFile.cached
+    _cache = {}
+
     def __init__(self, filename):
         self.filename = os.path.abspath(filename)
         self.logfilename = self.filename + '.log'
-        self.xmlfilenames = self.__getxmlfilenames(self._root())
-        self.sdpbargs = self.__getsdpbargs(self._root(), self.xmlfilenames)
-        self.outfile = self.__getoutfile(self.sdpbargs)
-        self.checkpointfile = self.__getcheckpointfile(self.sdpbargs)
+        self._stamp = None
+        # everything below is derived lazily from a single parse
+        self._rootel = None
+        self._xmlfilenames = None
+        self._sdpbargs = None
+        self._outfile = _unset
+        self._checkpointfile = _unset
+        self._warmstartfile = _unset
+        self._dict = _unset
+
+    @classmethod
+    def cached(cls, filename):
+        """
+        Return an SdpDataFile for filename, reusing the one from an earlier
+        call as long as the file has not been modified since.
+        """
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        sdpdata = cls._cache.get(filename)
+        if sdpdata is None or sdpdata._stamp != key:
+            sdpdata = cls(filename)
+            sdpdata._stamp = key
+            cls._cache[filename] = sdpdata
+        return sdpdata
+
+    @property
+    def xmlfilenames(self):
+        if self._xmlfilenames is None:
+            self._xmlfilenames = self.__getxmlfilenames(self._root())
+        return self._xmlfilenames
+
+    @property
+    def sdpbargs(self):
+        if self._sdpbargs is None:
+            self._sdpbargs = self.__getsdpbargs(self._root(),
+                                                self.xmlfilenames)
+        return self._sdpbargs
+
+    @property
+    def outfile(self):
+        if self._outfile is _unset:
+            self._outfile = self.__getoutfile(self.sdpbargs)
+        return self._outfile
+
+    @property
+    def checkpointfile(self):
+        if self._checkpointfile is _unset:
+            self._checkpointfile = self.__getcheckpointfile(self.sdpbargs)
+        return self._checkpointfile
+
+    @property
+    def backupcheckpointfile(self):
         if self.checkpointfile is not None:
-            self.backupcheckpointfile = self.checkpointfile + '.bk'
-        self.dict = self.__getdictortext(self._root())
+            return self.checkpointfile + '.bk'
+
+    @property
+    def sdpfiledata(self):
+        return self._root().findall('sdpFileData')
+
+    @property
+    def warmstartfile(self):
+        if self._warmstartfile is _unset:
+            self._warmstartfile = \
+                self._root().findtext('sdpbData/warmstart') or None
+        return self._warmstartfile
+
+    @property
+    def dict(self):
+        if self._dict is _unset:
+            self._dict = self.__getdictortext(self._root())
+        return self._dict
 
     def _tree(self):
-        return ET.parse(self.filename)
+        return ET.ElementTree(self._root())
 
     def _root(self):
-        return self._tree().getroot()
+        if self._rootel is None:
+            self._rootel = ET.parse(self.filename).getroot()
+        return self._rootel
 
     @staticmethod
     def __getdictortext(tree):
@@ -167,16 +256,64 @@ class SdpDataFileWriter:
 
         The outer tag is not part of this dict. It is commonly called 'sdp' but
         this is ignored.
+
+        Many updates can be combined in a transaction, which parses the file
+        once and writes it once:
+            with writer.transaction() as t:
+                t.update(dict1)
+                t.update(dict2)
+        The file is replaced atomically, so readers never see half of it.
+
+        A new file can be cloned from a source instead of from what is on
+        disk: an SdpDataFile, an xml Element or a dict as above.
         """
 
-        def __init__(self, filename):
+        def __init__(self, filename, source=None):
             self.filename = os.path.abspath(filename)
+            self.source = source
             # ensure file exists
-            if not os.path.isfile(filename):
+            if source is None and not os.path.isfile(filename):
                 with open(self.filename, 'a') as file:
                     file.write('<sdp>\n')
                     file.write('</sdp>\n')
 
+        def _sourceroot(self):
+            source = self.source
+            if source is None:
+                return ET.parse(self.filename).getroot()
+            # the source is used once; later transactions start from the file
+            self.source = None
+            if isinstance(source, SdpDataFile):
+                return copy.deepcopy(source._root())
+            elif isinstance(source, ET.Element):
+                return copy.deepcopy(source)
+            root = ET.Element('sdp')
+            self._updater(root, source)
+            return root
+
+        @contextlib.contextmanager
+        def transaction(self):
+            transaction = SdpDataFileTransaction(self._sourceroot())
+            yield transaction
+            self._write(transaction.root)
+
+        def _write(self, root):
+            self._prettify(root)
+            path, file = os.path.split(self.filename)
+            # unique per process and thread, as several may write one file
+            tmpfilename = os.path.join(
+                path, '.' + file + '.tmp' + str(os.getpid()) + '.' +
+                str(threading.get_ident()))
+            try:
+                with open(tmpfilename, 'wb') as tmpfile:
+                    ET.ElementTree(root).write(tmpfile)
+                if os.path.isfile(self.filename):
+                    shutil.copymode(self.filename, tmpfilename)
+                os.replace(tmpfilename, self.filename)
+            finally:
+                if os.path.isfile(tmpfilename):
+                    os.remove(tmpfilename)
+
         @staticmethod
         def _updater(xmlel, dict):
             for key, value in dict.items():
@@ -204,11 +341,17 @@ class SdpDataFileWriter:
             xmlel.tail = '\n' + ' ' * indent
 
         def updatefile(self, dict):
-            with open(self.filename, "r+b") as file:
-                maintree = ET.parse(file)
-                root = maintree.getroot()
-                self._updater(root, dict)
-                self._prettify(root)
-                file.seek(0)
-                maintree.write(file)
-                file.truncate()
+            with self.transaction() as transaction:
+                transaction.update(dict)
+
+
+class SdpDataFileTransaction:
+        """ The parsed tree that SdpDataFileWriter.transaction collects
+        updates in.
+        """
+
+        def __init__(self, root):
+            self.root = root
+
+        def update(self, dict):
+            SdpDataFileWriter._updater(self.root, dict)
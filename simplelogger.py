@@ -1,4 +1,11 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import fcntl
+import gzip
 import os.path
+import sqlite3
+import threading
 
 statuses = ['tosubmit',
             'submitted',
@@ -9,6 +16,10 @@ statuses = ['tosubmit',
             'concluded',
             'failed']
 
+# If a database with this name exists in the directory of a log, the
+# entries of the log are kept there instead of in the log file itself.
+dbname = 'sdplog.sqlite'
+
 
 class SimpleLogWriter:
     """
@@ -28,27 +39,35 @@ class SimpleLogWriter:
 
     Special entries are those where expression is 'status'. The bonusexpression
     can then be only an element of statuses and set through setstatus.
+
+    If the directory of the log holds a LogDatabase (see dbname), the entries
+    go there instead and no log file is created.
     """
 
     def __init__(self, acro, filename):
         self.filename = os.path.abspath(filename)
         self.acro = acro
-        if not os.path.isfile(filename):
+        self.db = LogDatabase.find(self.filename)
+        if self.db is None and not os.path.isfile(filename):
             open(filename, 'a').close()
         self.fp = None
 
     # allows 'with' but is not used because the cern world is a weird world
     def __enter__(self):
-        self.fp = open(self.filename, 'a', 1)
+        if self.db is None:
+            self.fp = open(self.filename, 'a', 1)
         return self
 
     # see previous comment
     def __exit__(self, type, value, traceback):
-        self.fp.close()
-        self.fp = None
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
 
     def write(self, expr, bonusexpr=None):
-        if self.fp is not None:
+        if self.db is not None:
+            self.db.append(self.filename, self.acro, expr, bonusexpr)
+        elif self.fp is not None:
             self._writep(expr, bonusexpr)
         else:
             self.__enter__()
@@ -61,11 +80,45 @@ class SimpleLogWriter:
         assert status in statuses
         self.write('status', status)
 
-    def _writep(self, expr, bonusexpr=None):
-        self.fp.write(self.acro + ' :: ' + str(expr))
+    @staticmethod
+    def _formatline(acro, expr, bonusexpr=None):
+        line = acro + ' :: ' + str(expr)
         if bonusexpr is not None:
-            self.fp.write(' :: ' + str(bonusexpr))
-        self.fp.write('\n')
+            line += ' :: ' + str(bonusexpr)
+        return line + '\n'
+
+    def _writep(self, expr, bonusexpr=None):
+        line = self._formatline(self.acro, expr, bonusexpr)
+        self.fp.write(line)
+        # keep a cached snapshot of this log up to date without rereading
+        state = LogState._cache.get(self.filename)
+        if state is not None:
+            state._appended(line.encode(self.fp.encoding), self.fp.fileno())
+
+
+@contextlib.contextmanager
+def locklog(filename):
+    """
+    Context manager taking an advisory lock on a log without blocking. It
+    yields whether the lock was obtained; only one process, or one thread
+    within a process, can hold it at a time.
+
+    Like everything else about a job, the lock lives in its log: afs at CERN
+    does not like having too many files in one dir. With a LogDatabase there
+    is no log file and the lock is taken on the xml file instead.
+    """
+    if LogDatabase.find(filename) is not None:
+        filename = os.path.splitext(filename)[0]
+    with open(filename, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
 class SimpleLogReader:
@@ -76,26 +129,72 @@ class SimpleLogReader:
 
     def __init__(self, filename):
         self.filename = os.path.abspath(filename)
+        self.db = LogDatabase.find(self.filename)
         # ensure file exists to make other functions work
-        if not os.path.isfile(filename):
+        if self.db is None and not os.path.isfile(filename):
             open(filename, 'a').close()
 
+    # size of the blocks read by reversedentries
+    blocksize = 8192
+
     def entries(self):
+        if self.db is not None:
+            yield from self.db.entries(self.filename)
+            return
         with open(self.filename, 'r') as f:
-            for line in list(f):
+            for line in f:
                 yield line.rstrip().split(' :: ')
 
     def reversedentries(self):
-        return iter(reversed(list(self.entries())))
+        """
+        Yields the entries from last to first. The file is read backwards in
+        blocks, so a search that stops early never reads the start of a long
+        log.
+        """
+        if self.db is not None:
+            yield from self.db.entries(self.filename, reverse=True)
+            return
+        with open(self.filename, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            rest = None
+            while pos > 0:
+                size = min(self.blocksize, pos)
+                pos -= size
+                f.seek(pos)
+                block = f.read(size)
+                if rest is None:
+                    # a trailing newline does not start a new entry
+                    if block.endswith(b'\n'):
+                        block = block[:-1]
+                    rest = b''
+                lines = (block + rest).split(b'\n')
+                # the first line may continue in the previous block
+                rest = lines[0]
+                for line in reversed(lines[1:]):
+                    yield self._split(line)
+            if rest is not None:
+                yield self._split(rest)
+
+    @staticmethod
+    def _split(rawline):
+        return rawline.decode(errors='replace').rstrip().split(' :: ')
 
     def numlineswith(self, acro=None, expr=None, bonusexpr=None):
+        if self.db is not None:
+            return self.db.numlineswith(self.filename, acro, expr, bonusexpr)
         i = 0
         for line in self.entries():
-            if self._match(line, acro, expr, bonusexpr):
+            if line[:2] == ['cmp', 'numlines'] and len(line) > 3:
+                # lines that compactlog dropped
+                if self._match(line[3:], acro, expr, bonusexpr):
+                    i += int(line[2])
+            elif self._match(line, acro, expr, bonusexpr):
                 i += 1
         return i
 
     def lastlinewith(self, acro=None, expr=None, bonusexpr=None):
+        if self.db is not None:
+            return self.db.lastlinewith(self.filename, acro, expr, bonusexpr)
         for line in self.reversedentries():
             if self._match(line, acro, expr, bonusexpr):
                 return line
@@ -131,3 +230,447 @@ class SimpleLogReader:
             elif line[2] != bonusexpr:
                 return False
         return True
+
+
+class LogState:
+    """
+    Snapshot of a log, built in a single pass over the file. It holds the
+    current status, the last bonusexpression of every expression, the number
+    of submissions and the file(s) this one was replaced with.
+
+    Obtain snapshots through LogState.get, which caches them per file against
+    the inode, size and mtime of the log. When the log has grown, only the
+    appended part is read; appends through a SimpleLogWriter in the same
+    process are folded in directly. For a log in a LogDatabase, the snapshot
+    is an indexed query, cached against the id of the last entry.
+    """
+
+    _cache = {}
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.last = {}
+        self.submissions = 0
+        self.replacements = []
+        # position up to which the log has been folded in and the stat of
+        # the log at that time
+        self.offset = 0
+        self.inode = None
+        self.mtime = None
+
+    @classmethod
+    def get(cls, filename):
+        filename = os.path.abspath(filename)
+        db = LogDatabase.find(filename)
+        if db is not None:
+            return cls._getfromdb(filename, db)
+        if not os.path.isfile(filename):
+            open(filename, 'a').close()
+        st = os.stat(filename)
+        state = cls._cache.get(filename)
+        if state is not None and state.inode == st.st_ino and \
+                state.offset == st.st_size and state.mtime == st.st_mtime_ns:
+            return state
+        if state is None or state.inode != st.st_ino or \
+                state.offset >= st.st_size:
+            # new, rewritten or truncated log: start over
+            state = cls(filename)
+            cls._cache[filename] = state
+        state._readfrom(state.offset)
+        return state
+
+    @classmethod
+    def _getfromdb(cls, filename, db):
+        lastid = db.lastid(filename)
+        state = cls._cache.get(filename)
+        if state is None or state.inode != db.filename or \
+                state.offset != lastid:
+            state = cls(filename)
+            state.last, state.submissions, state.replacements = \
+                db.snapshot(filename)
+            state.offset = lastid
+            state.inode = db.filename
+            cls._cache[filename] = state
+        return state
+
+    @property
+    def version(self):
+        """
+        Changes whenever the log does.
+        """
+        return self.inode, self.offset, self.mtime
+
+    @property
+    def status(self):
+        status = self.last.get('status')
+        assert status in statuses or status is None
+        return status
+
+    @property
+    def replacedwith(self):
+        return self.last.get('replaced with')
+
+    def _fold(self, line):
+        if len(line) < 2:
+            return
+        if line[0] == 'cmp':
+            # see compactlog: the submissions that compaction dropped
+            if line[1] == 'numlines' and line[4:6] == ['status', 'submitted']:
+                self.submissions += int(line[2])
+            return
+        bonusexpr = line[2] if len(line) > 2 else None
+        self.last[line[1]] = bonusexpr
+        if line[1] == 'status' and bonusexpr == 'submitted':
+            self.submissions += 1
+        elif line[1] == 'replaced with':
+            self.replacements.append(bonusexpr)
+
+    def _readfrom(self, offset):
+        with open(self.filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            f.seek(offset)
+            data = f.read()
+        # leave a partially written last line for the next call
+        end = data.rfind(b'\n') + 1
+        for rawline in data[:end].splitlines():
+            self._fold(SimpleLogReader._split(rawline))
+        self.offset = offset + end
+        self.inode = st.st_ino
+        self.mtime = st.st_mtime_ns
+
+    def _appended(self, rawline, fileno):
+        st = os.fstat(fileno)
+        # only fold in if nobody else wrote since our last look
+        if st.st_ino == self.inode and \
+                st.st_size - len(rawline) == self.offset:
+            self._fold(SimpleLogReader._split(rawline.rstrip(b'\n')))
+            self.offset = st.st_size
+            self.mtime = st.st_mtime_ns
+
+
+class LogDatabase:
+    """
+    Keeps the entries of all logs of a campaign in a single SQLite database,
+    as an alternative to one log file per job. It sits in the directory of
+    the logs under the name dbname; SimpleLogWriter, SimpleLogReader and
+    LogState use it automatically for every log in that directory. Entries
+    are indexed by log and expression, so status and 'last value' lookups
+    are indexed queries.
+
+    The database runs in WAL mode, which needs all its users on one machine
+    (shared memory does not work over afs): use it with the local world.
+
+    Run this file with 'import' or 'export' to convert existing logs.
+    """
+
+    # connections cannot be shared between threads
+    _local = threading.local()
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.conn = sqlite3.connect(self.filename, timeout=60,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                          'id INTEGER PRIMARY KEY, log TEXT NOT NULL, '
+                          'acro TEXT, expr TEXT, bonusexpr TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_log_expr '
+                          'ON entries (log, expr)')
+
+    @classmethod
+    def find(cls, logfilename):
+        """
+        The database for a log, or None if its directory has none.
+        """
+        dbfilename = os.path.join(os.path.dirname(logfilename), dbname)
+        if not os.path.isfile(dbfilename):
+            return None
+        return cls.open(dbfilename)
+
+    @classmethod
+    def open(cls, dbfilename):
+        dbs = cls._local.__dict__.setdefault('dbs', {})
+        dbfilename = os.path.abspath(dbfilename)
+        if dbfilename not in dbs:
+            dbs[dbfilename] = cls(dbfilename)
+        return dbs[dbfilename]
+
+    @staticmethod
+    def _key(logfilename):
+        return os.path.basename(logfilename)
+
+    @staticmethod
+    def _entry(row):
+        return [field for field in row if field is not None]
+
+    def logs(self):
+        """
+        The filenames of all logs in the database.
+        """
+        rows = self.conn.execute('SELECT DISTINCT log FROM entries')
+        return [os.path.join(os.path.dirname(self.filename), row[0])
+                for row in rows]
+
+    def append(self, logfilename, acro, expr, bonusexpr=None):
+        self.appendmany(logfilename, [(acro, expr, bonusexpr)])
+
+    def appendmany(self, logfilename, entries):
+        key = self._key(logfilename)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO entries (log, acro, expr, bonusexpr) '
+                'VALUES (?, ?, ?, ?)',
+                [(key, acro, str(expr),
+                  None if bonusexpr is None else str(bonusexpr))
+                 for acro, expr, bonusexpr in entries])
+
+    def entries(self, logfilename, reverse=False):
+        order = 'DESC' if reverse else 'ASC'
+        rows = self.conn.execute('SELECT acro, expr, bonusexpr FROM entries '
+                                 'WHERE log = ? ORDER BY id ' + order,
+                                 (self._key(logfilename),))
+        for row in rows:
+            yield self._entry(row)
+
+    @staticmethod
+    def _where(acro, expr, bonusexpr):
+        where = ' WHERE log = ?'
+        values = []
+        for column, value in [('acro', acro), ('expr', expr),
+                              ('bonusexpr', bonusexpr)]:
+            if value is not None:
+                where += ' AND ' + column + ' = ?'
+                values.append(value)
+        return where, values
+
+    def numlineswith(self, logfilename, acro=None, expr=None, bonusexpr=None):
+        where, values = self._where(acro, expr, bonusexpr)
+        key = self._key(logfilename)
+        row = self.conn.execute(
+            'SELECT count(*) FROM entries' + where +
+            " AND NOT (acro = 'cmp' AND expr = 'numlines')",
+            [key] + values).fetchone()
+        i = row[0]
+        # lines that compactlog dropped, as in SimpleLogReader.numlineswith
+        rows = self.conn.execute("SELECT bonusexpr FROM entries WHERE log = ? "
+                                 "AND acro = 'cmp' AND expr = 'numlines'",
+                                 (key,))
+        for row in rows:
+            line = row[0].split(' :: ')
+            if len(line) > 1 and \
+                    SimpleLogReader._match(line[1:], acro, expr, bonusexpr):
+                i += int(line[0])
+        return i
+
+    def lastlinewith(self, logfilename, acro=None, expr=None, bonusexpr=None):
+        where, values = self._where(acro, expr, bonusexpr)
+        row = self.conn.execute('SELECT acro, expr, bonusexpr FROM entries' +
+                                where + ' ORDER BY id DESC LIMIT 1',
+                                [self._key(logfilename)] + values).fetchone()
+        if row is not None:
+            return self._entry(row)
+
+    def lastid(self, logfilename):
+        row = self.conn.execute('SELECT max(id) FROM entries WHERE log = ?',
+                                (self._key(logfilename),)).fetchone()
+        return row[0]
+
+    def snapshot(self, logfilename):
+        """
+        The last bonusexpression per expression, the number of submissions
+        and the replacements of a log, as kept by LogState.
+        """
+        key = self._key(logfilename)
+        # SQLite takes the bare column from the row with the max(id)
+        # like LogState._fold, skip the records of compactlog
+        rows = self.conn.execute(
+            'SELECT expr, bonusexpr, max(id) FROM entries '
+            "WHERE log = ? AND acro != 'cmp' GROUP BY expr", (key,))
+        last = {expr: bonusexpr for expr, bonusexpr, _ in rows}
+        submissions = self.numlineswith(logfilename, expr='status',
+                                        bonusexpr='submitted')
+        rows = self.conn.execute('SELECT bonusexpr FROM entries '
+                                 'WHERE log = ? AND expr = ? ORDER BY id',
+                                 (key, 'replaced with'))
+        return last, submissions, [row[0] for row in rows]
+
+
+def importlogs(logfilenames, remove=False):
+    """
+    Copy text logs into the database of their directory, creating it if
+    necessary. Logs that already have entries there are skipped.
+    """
+    for logfilename in map(os.path.abspath, logfilenames):
+        db = LogDatabase.open(os.path.join(os.path.dirname(logfilename),
+                                           dbname))
+        if db.lastid(logfilename) is not None:
+            print('Skipped ' + logfilename + ': already in ' + db.filename)
+            continue
+        entries = []
+        with open(logfilename, 'r') as f:
+            for line in f:
+                entry = line.rstrip().split(' :: ', 2)
+                if len(entry) > 1:
+                    entries.append((entry + [None])[:3])
+        db.appendmany(logfilename, entries)
+        if remove:
+            os.remove(logfilename)
+        print('Imported ' + logfilename + ' into ' + db.filename)
+
+
+def exportlogs(dbfilename, logfilenames=None):
+    """
+    Write logs from a database back to text log files, by default all of
+    them. Remove the database afterwards to go back to text logs.
+    """
+    db = LogDatabase.open(dbfilename)
+    if not logfilenames:
+        logfilenames = db.logs()
+    for logfilename in map(os.path.abspath, logfilenames):
+        with open(logfilename, 'w') as f:
+            for entry in db.entries(logfilename):
+                f.write(SimpleLogWriter._formatline(*entry))
+        print('Exported ' + logfilename + ' from ' + db.filename)
+
+
+# statuses of logs that no worker writes to, which can be compacted
+idlestatuses = ['finished', 'concluded', 'failed']
+
+
+def compactlog(filename, keep=20, minlines=100):
+    """
+    Rewrite a long log as a snapshot of its history followed by its last
+    keep entries, and append the history to the compressed archive
+    <log>.gz. The snapshot holds the last entry of every acronym and
+    expression, all 'replaced with' entries and all timing ('tim') entries,
+    which timingreport reads, in their original order:
+
+    cmp :: compacted :: <archive>
+    cmp :: numlines :: N :: acro :: status :: bonusexpr
+    ...
+    cmp :: snapshot end
+    <the last keep entries>
+
+    The numlines entries count the status entries that were dropped, so
+    that numlineswith and LogState.submissions (and hence --maxsubmissions)
+    give the same answers as before. A log is only compacted when it has at
+    least minlines entries and an idle status, and it is replaced
+    atomically, provided nothing was written to it meanwhile. Returns
+    whether the log was compacted. Logs in a LogDatabase are left alone.
+    """
+    filename = os.path.abspath(filename)
+    if LogDatabase.find(filename) is not None or \
+            not os.path.isfile(filename):
+        return False
+    state = LogState.get(filename)
+    if state.status not in idlestatuses:
+        return False
+    with open(filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    if not data.endswith(b'\n'):
+        # someone is writing after all
+        return False
+    rawlines = data.split(b'\n')[:-1]
+    if len(rawlines) < max(minlines, keep + 1):
+        return False
+    split = len(rawlines) - keep
+    tail = rawlines[split:]
+
+    counts = {}
+    history = []
+    candidates = []
+    insnapshot = False
+    for rawline in rawlines[:split]:
+        line = SimpleLogReader._split(rawline)
+        if line[0] == 'cmp':
+            if line[1:2] == ['compacted']:
+                insnapshot = True
+            elif line[1:2] == ['snapshot end']:
+                insnapshot = False
+            elif line[1:2] == ['numlines'] and len(line) > 3:
+                key = tuple(line[3:])
+                counts[key] = counts.get(key, 0) + int(line[2])
+            continue
+        # a previous snapshot is archived already
+        if not insnapshot:
+            history.append(rawline)
+        candidates.append((line, rawline))
+        if line[1:2] == ['status']:
+            counts[tuple(line)] = counts.get(tuple(line), 0) + 1
+    lastindex = {tuple(line[:2]): i
+                 for i, (line, _) in enumerate(candidates)}
+    snapshot = []
+    for i, (line, rawline) in enumerate(candidates):
+        if lastindex[tuple(line[:2])] == i or line[0] == 'tim' or \
+                line[1:2] == ['replaced with']:
+            snapshot.append(rawline)
+            if line[1:2] == ['status']:
+                counts[tuple(line)] -= 1
+
+    archivefilename = filename + '.gz'
+    newlines = [SimpleLogWriter._formatline(
+        'cmp', 'compacted', os.path.basename(archivefilename)).encode()]
+    for key, count in counts.items():
+        if count > 0:
+            newlines.append(SimpleLogWriter._formatline(
+                'cmp', 'numlines', ' :: '.join((str(count),) + key)).encode())
+    newlines += [rawline + b'\n' for rawline in snapshot]
+    newlines.append(SimpleLogWriter._formatline('cmp',
+                                                'snapshot end').encode())
+    newlines += [rawline + b'\n' for rawline in tail]
+
+    # the compacted log must tell the same story
+    newstate = LogState(filename)
+    for rawline in newlines:
+        newstate._fold(SimpleLogReader._split(rawline.rstrip(b'\n')))
+    if (newstate.status, newstate.submissions, newstate.replacements) != \
+            (state.status, state.submissions, state.replacements):
+        raise RuntimeError('compaction of ' + filename + ' would change it')
+
+    tmpfilename = filename + '.tmp' + str(os.getpid())
+    with open(tmpfilename, 'wb') as f:
+        f.writelines(newlines)
+    os.chmod(tmpfilename, st.st_mode)
+    newst = os.stat(filename)
+    if (newst.st_ino, newst.st_size) != (st.st_ino, len(data)):
+        os.remove(tmpfilename)
+        return False
+    with gzip.open(archivefilename, 'ab') as archive:
+        archive.writelines(rawline + b'\n' for rawline in history)
+    os.replace(tmpfilename, filename)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Convert between text logs and a log database, or '
+                    'compact text logs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    importparser = subparsers.add_parser(
+        'import', help='copy text logs into the database of their directory')
+    importparser.add_argument('logfilenames', metavar='log', nargs='+')
+    importparser.add_argument('--remove', action='store_true',
+                              help='remove the text logs once imported')
+    exportparser = subparsers.add_parser(
+        'export', help='write logs from a database back to text files')
+    exportparser.add_argument('dbfilename', metavar='db')
+    exportparser.add_argument('logfilenames', metavar='log', nargs='*',
+                              help='the logs to export (default: all)')
+    compactparser = subparsers.add_parser(
+        'compact', help='fold the history of long idle logs into a snapshot '
+                        'and archive it')
+    compactparser.add_argument('logfilenames', metavar='log', nargs='+')
+    compactparser.add_argument('--keep', type=int, default=20,
+                               help='number of recent entries to keep')
+    compactparser.add_argument('--minlines', type=int, default=100,
+                               help='leave logs with fewer entries alone')
+    args = parser.parse_args()
+    if args.command == 'import':
+        importlogs(args.logfilenames, args.remove)
+    elif args.command == 'export':
+        exportlogs(args.dbfilename, args.logfilenames)
+    else:
+        for logfilename in args.logfilenames:
+            if compactlog(logfilename, args.keep, args.minlines):
+                print('Compacted ' + logfilename)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os.path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# how to start every entry point without giving it anything to do: the
+# babysitter and cleanup.py set up the world and find an empty manifest;
+# the worker is measured up to setting up the world, as it would run a job
+# after that; the others stop after parsing --help
+entrypoints = {
+    'babysitter': ['babysitter.py', '-w', '{world}', '-M', '{manifest}'],
+    'cleanup': ['cleanup.py', '-w', '{world}', '-M', '{manifest}', '-n'],
+    'worker': ['-c', 'import sdpdatafile, simplelogger, manyworlds; '
+               'manyworlds.getworld("{world}")'],
+    'timingreport': ['timingreport.py', '-M', '{manifest}'],
+    'localworld': ['localworld.py', '--help'],
+    'analyzer': ['analyzer.py', '--help'],
+    'simplelogger': ['simplelogger.py', '--help'],
+    'sweep': ['sweep.py', '--help'],
+}
+
+# modules that only some code paths need, and that should not be imported
+# at startup
+heavymodules = ['analyzer', 'mpmath', 'htcondor']
+
+
+def importtimes(stderr):
+    """
+    The cumulative import time in seconds of every module, from the output
+    of python -X importtime, and the total of the top level imports.
+    """
+    modules = {}
+    total = 0.
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1]) / 1e6
+        except ValueError:
+            # the header
+            continue
+        name = fields[2].rstrip()
+        modules[name.strip()] = cumulative
+        if not name.startswith('  '):
+            total += cumulative
+    return modules, total
+
+
+def measure(entrypoint, directory, world, workdir, pythonpath):
+    """
+    Start the entry point once, in the given world. Returns its wall time
+    and the output of importtime.
+    """
+    command = [argument.format(world=world,
+                               manifest=os.path.join(workdir, 'empty.tsv'))
+               for argument in entrypoints[entrypoint]]
+    if command[0].endswith('.py'):
+        command[0] = os.path.join(directory, command[0])
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        pythonpath + [env['PYTHONPATH']] if env.get('PYTHONPATH')
+        else pythonpath)
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + command, cwd=directory,
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        encoding='utf-8')
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(entrypoint + ' did not start:\n' + process.stderr)
+    return wall, process.stderr
+
+
+def benchmark(entrypoint, directory, world, workdir, pythonpath, repeats,
+              top):
+    """
+    Median wall time and import time of starting the entry point, the
+    modules that take longest to import, and the heavy modules among the
+    imports.
+    """
+    walls = []
+    totals = []
+    modules = {}
+    for repeat in range(repeats):
+        wall, stderr = measure(entrypoint, directory, world, workdir,
+                               pythonpath)
+        times, total = importtimes(stderr)
+        walls.append(wall)
+        totals.append(total)
+        for name, cumulative in times.items():
+            modules.setdefault(name, []).append(cumulative)
+    medians = {name: statistics.median(values)
+               for name, values in modules.items()}
+    slowest = sorted(medians.items(), key=lambda m: m[1], reverse=True)
+    return {'wall': statistics.median(walls),
+            'imports': statistics.median(totals),
+            'slowest': dict(slowest[:top]),
+            'heavy': [name for name in heavymodules if name in medians]}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare wall times with those of the same entry points in baseline.
+    Returns the ratios and whether any of them exceeds tolerance.
+    """
+    ratios = {entrypoint: result['wall'] / baseline['results'][entrypoint]
+              ['wall'] for entrypoint, result in results.items()
+              if entrypoint in baseline['results']}
+    return ratios, any(ratio > tolerance for ratio in ratios.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Time the startup of every entry point, and what it
+                       imports, with python -X importtime. Reports the
+                       results as JSON.""")
+    parser.add_argument('entrypoints', metavar='ep', nargs='*',
+                        default=list(entrypoints),
+                        help="""entry points to time (default: all of """ +
+                        ', '.join(entrypoints) + ')')
+    parser.add_argument('-w', '--world', choices=['local', 'cern', 'fake'],
+                        default='cern',
+                        help="""the world that is set up""")
+    parser.add_argument('-P', '--pythonpath', action='append', default=[],
+                        help="""a directory to put in front of the PYTHONPATH
+                                of the entry points, e.g. with a stand-in
+                                htcondor module; may be repeated""")
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help="""number of starts per entry point""")
+    parser.add_argument('-n', '--top', type=int, default=5,
+                        help="""number of slowest imports to report""")
+    parser.add_argument('-o', '--output',
+                        help="""write the JSON here instead of to stdout""")
+    parser.add_argument('-b', '--baseline',
+                        help="""JSON of an earlier run to compare with; exit
+                                with status 1 on a regression""")
+    parser.add_argument('-t', '--tolerance', type=float, default=1.25,
+                        help="""ratio to the baseline that counts as a
+                                regression""")
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error('at least one repeat is needed')
+
+    for entrypoint in args.entrypoints:
+        if entrypoint not in entrypoints:
+            parser.error('unknown entry point ' + entrypoint)
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    pythonpath = list(map(os.path.abspath, args.pythonpath))
+    # for the empty manifest
+    workdir = tempfile.mkdtemp(prefix='sdpstartup')
+    try:
+        results = {entrypoint: benchmark(entrypoint, directory, args.world,
+                                         workdir, pythonpath, args.repeats,
+                                         args.top)
+                   for entrypoint in args.entrypoints}
+    finally:
+        shutil.rmtree(workdir)
+    report = {'python': platform.python_version(),
+              'results': results}
+    regressed = False
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['comparisons'], regressed = \
+            compare(results, baseline, args.tolerance)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if regressed:
+        exit(1)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import argparse
+import decimal
+import itertools
+import multiprocessing
+import os
+import sdpdatafile
+
+
+def decimalrange(start, stop, step):
+    """
+    The values start, start + step, ... below stop, as strings. Computed in
+    decimal arithmetic, so 0.1 + 0.3 is 0.4 and not 0.39999999999999997.
+    """
+    start, stop, step = map(decimal.Decimal, map(str, [start, stop, step]))
+    values = []
+    value = start
+    while value < stop:
+        values.append(str(value))
+        value += step
+    return values
+
+
+def product(axes):
+    """
+    All combinations of the values of the axes, a dict of key -> values.
+    Returns a list of dicts key -> value.
+    """
+    keys = list(axes)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*axes.values())]
+
+
+def zipped(axes):
+    """
+    Like product, but the n-th point takes the n-th value of every axis.
+    """
+    keys = list(axes)
+    return [dict(zip(keys, values)) for values in zip(*axes.values())]
+
+
+def updatedict(point):
+    """
+    The SdpDataFileWriter update for a point. A plain key is an entry of
+    <sdpFileData>; a key like 'sdpbData/params/precision' is a path from
+    the outer tag.
+    """
+    update = {}
+    for key, value in point.items():
+        path = key.split('/') if '/' in key else ['sdpFileData', key]
+        entry = update
+        for tag in path[:-1]:
+            entry = entry.setdefault(tag, {})
+        entry[path[-1]] = value
+    return update
+
+
+class Sweep:
+    """
+    Creates one sdp data file per point of a parameter sweep from a
+    template, which is parsed only once.
+
+    Point i becomes <template>_i.xml in outdir, with its sdp file renamed
+    to <sdp file>_i.xml. With a shardsize, the files go to subdirectories
+    of at most shardsize points each (000/, 001/, ...), and so do the sdp
+    files, to keep directories small. A manifest <template>.manifest.tsv in
+    outdir lists every file created with its point.
+    """
+
+    def __init__(self, template, outdir=None, shardsize=None):
+        self.templatedata = sdpdatafile.SdpDataFile(template)
+        self.outdir = outdir if outdir is not None else \
+            os.path.dirname(self.templatedata.filename)
+        self.shardsize = shardsize
+        self.base = os.path.splitext(
+            os.path.basename(self.templatedata.filename))[0]
+        sdpfiledict = self.templatedata.dict.get('sdpFileData')
+        self.sdpfilename = sdpfiledict.get('filename') \
+            if hasattr(sdpfiledict, 'get') else None
+
+    @property
+    def manifestfilename(self):
+        return os.path.join(self.outdir, self.base + '.manifest.tsv')
+
+    def _shard(self, i):
+        if self.shardsize is None:
+            return ''
+        return '{:03d}'.format(i // self.shardsize)
+
+    def filename(self, i):
+        return os.path.join(self.outdir, self._shard(i),
+                            self.base + '_' + str(i) + '.xml')
+
+    def _pointupdate(self, i, point):
+        update = updatedict(point)
+        if self.sdpfilename is not None:
+            path, file = os.path.split(self.sdpfilename)
+            f, e = os.path.splitext(file)
+            update.setdefault('sdpFileData', {})['filename'] = \
+                os.path.join(path, self._shard(i), f + '_' + str(i) + e)
+        return update
+
+    def writepoint(self, i, point):
+        filename = self.filename(i)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        writer = sdpdatafile.SdpDataFileWriter(filename, self.templatedata)
+        writer.updatefile(self._pointupdate(i, point))
+        return filename
+
+    def _writepoints(self, indexedpoints):
+        return [self.writepoint(i, point) for i, point in indexedpoints]
+
+    def write(self, points, processes=1, chunksize=500):
+        """
+        Create the files of all points and the manifest, and return the
+        filenames. With several processes, chunks of points are written in
+        parallel.
+        """
+        points = list(points)
+        indexed = list(enumerate(points))
+        chunks = [indexed[i:i + chunksize]
+                  for i in range(0, len(indexed), chunksize)]
+        if processes > 1 and len(chunks) > 1:
+            # the parsed template travels with the Sweep to every process
+            with multiprocessing.Pool(processes) as pool:
+                filenames = sum(pool.map(self._writepoints, chunks), [])
+        else:
+            filenames = sum(map(self._writepoints, chunks), [])
+        self.writemanifest(filenames, points)
+        return filenames
+
+    def writemanifest(self, filenames, points):
+        keys = []
+        for point in points:
+            keys += [key for key in point if key not in keys]
+        tmpfilename = self.manifestfilename + '.tmp'
+        with open(tmpfilename, 'w') as manifest:
+            manifest.write('\t'.join(['filename'] + keys) + '\n')
+            for filename, point in zip(filenames, points):
+                manifest.write('\t'.join(
+                    [os.path.relpath(filename, self.outdir)] +
+                    [str(point.get(key, '')) for key in keys]) + '\n')
+        os.replace(tmpfilename, self.manifestfilename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Create the sdp data files of a parameter sweep from a
+                       template. Keys are entries of <sdpFileData>, or paths
+                       like sdpbData/params/precision.""")
+    parser.add_argument('template', help='the template sdp data file')
+    parser.add_argument('-g', '--grid', nargs=4, action='append', default=[],
+                        metavar=('KEY', 'START', 'STOP', 'STEP'),
+                        help="""values START, START+STEP, ... below STOP""")
+    parser.add_argument('-l', '--list', nargs=2, action='append', default=[],
+                        metavar=('KEY', 'VALUES'),
+                        help="""comma separated values""")
+    parser.add_argument('-z', '--zip', action='store_true',
+                        help="""zip the axes instead of taking all
+                                combinations""")
+    parser.add_argument('-o', '--outdir',
+                        help="""where to create the files (default: next to
+                                the template)""")
+    parser.add_argument('-s', '--shardsize', type=int,
+                        help="""put at most this many files in one
+                                subdirectory""")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="""number of processes writing files""")
+    args = parser.parse_args()
+
+    axes = {}
+    for key, start, stop, step in args.grid:
+        axes[key] = decimalrange(start, stop, step)
+    for key, values in args.list:
+        axes[key] = values.split(',')
+    if not axes:
+        parser.error('no axes given')
+    points = zipped(axes) if args.zip else product(axes)
+    sweep = Sweep(args.template, args.outdir, args.shardsize)
+    filenames = sweep.write(points, args.processes)
+    print('Created ' + str(len(filenames)) + ' files, listed in ' +
+          sweep.manifestfilename + '.')
@@ -0,0 +1,19 @@
+"""
+A minimal stand-in for the htcondor bindings, enough for CernWorld to
+write submit descriptions where the bindings are not installed.
+"""
+
+
+class Submit(dict):
+
+    def __init__(self, description=None):
+        super().__init__(description or {})
+        self.qargs = ''
+
+    def setQArgs(self, args):
+        self.qargs = args
+
+    def __str__(self):
+        return ''.join(key + ' = ' + str(value) + '\n'
+                       for key, value in self.items()) + \
+            ('queue ' + self.qargs if self.qargs else 'queue') + '\n'
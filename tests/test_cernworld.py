@@ -0,0 +1,143 @@
+import os
+import subprocess as sp
+import pytest
+import cernworld
+import sdpdatafile
+
+testsdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def writesdpdata(filename, flavour):
+    with open(filename, 'w') as f:
+        f.write('<sdp>\n<cernworld>\n    <cluster>\n'
+                '        <JobFlavour>' + flavour + '</JobFlavour>\n'
+                '    </cluster>\n</cernworld>\n</sdp>\n')
+    return sdpdatafile.SdpDataFile(filename)
+
+
+@pytest.fixture
+def condorsubmit(tmp_path, monkeypatch):
+    """
+    Put the stand-in condor_submit first on the PATH. Returns a function
+    giving the submit descriptions it received.
+    """
+    record = tmp_path / 'submitted'
+    # the stand-in bindings, unless the real ones are installed
+    try:
+        import htcondor
+    except ImportError:
+        monkeypatch.syspath_prepend(os.path.join(testsdir, 'stubs'))
+    monkeypatch.setenv('PATH', testsdir + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('CONDOR_SUBMIT_RECORD', str(record))
+
+    def descriptions():
+        return record.read_text().split('\n---\n')[:-1]
+    return descriptions
+
+
+def test_submit(tmp_path, condorsubmit):
+    sdpdata = writesdpdata(str(tmp_path / 'a.xml'), 'espresso')
+    assert cernworld.CernWorld().submit(sdpdata) == '100'
+    description, = condorsubmit()
+    assert sdpdata.filename in description
+    assert '.a.xml.condorlog' in description
+
+
+def test_submitmany(tmp_path, condorsubmit):
+    sdpdatas = [writesdpdata(str(tmp_path / name), flavour)
+                for name, flavour in [('a.xml', 'espresso'),
+                                      ('b.xml', 'longlunch'),
+                                      ('c.xml', 'espresso')]]
+    submissionids = cernworld.CernWorld().submitmany(sdpdatas)
+    # one cluster per distinct setting, procs in the order of the items
+    assert submissionids == ['100.0', '101.0', '100.1']
+    espresso, longlunch = condorsubmit()
+    for description in [espresso, longlunch]:
+        assert '$(sdpfile)' in description
+        assert '$(condorlog)' in description
+        assert 'from (' in description
+    assert 'espresso' in espresso and 'longlunch' in longlunch
+    items = espresso[espresso.index('from (') + len('from ('):].split()
+    assert items[:8] == [
+        sdpdatas[0].filename, str(tmp_path / '.a.xml.condorlog'),
+        str(tmp_path / '.a.xml.out'), str(tmp_path / '.a.xml.err'),
+        sdpdatas[2].filename, str(tmp_path / '.c.xml.condorlog'),
+        str(tmp_path / '.c.xml.out'), str(tmp_path / '.c.xml.err')]
+    assert sdpdatas[1].filename in longlunch
+    assert sdpdatas[1].filename not in espresso
+
+
+def test_submitmany_partial(tmp_path, condorsubmit, monkeypatch):
+    monkeypatch.setenv('CONDOR_SUBMIT_FAIL', '101')
+    sdpdatas = [writesdpdata(str(tmp_path / name), flavour)
+                for name, flavour in [('a.xml', 'espresso'),
+                                      ('b.xml', 'longlunch'),
+                                      ('c.xml', 'espresso')]]
+    with pytest.raises(sp.CalledProcessError) as excinfo:
+        cernworld.CernWorld().submitmany(sdpdatas)
+    # the jobs of the first group were queued before the second failed
+    assert excinfo.value.submissionids == ['100.0', None, '100.1']
+    assert len(condorsubmit()) == 1
+
+
+class FakeSchedd:
+    """
+    Answers the queries of CernWorld from a list of job ads, and records
+    them.
+    """
+
+    def __init__(self, ads):
+        self.ads = ads
+        self.queries = []
+
+    def xquery(self, requirements, projection):
+        self.queries.append(requirements)
+        if requirements.startswith('member(ClusterId, {'):
+            clusters = requirements[len('member(ClusterId, {'):-2]
+            clusters = [int(c) for c in clusters.split(', ')]
+            return iter([ad for ad in self.ads if ad['ClusterId'] in clusters])
+        constraint = dict(part.split(' =?= ')
+                          for part in requirements.split(' && '))
+        return iter([ad for ad in self.ads
+                     if all(str(ad[key]) == value
+                            for key, value in constraint.items())])
+
+
+@pytest.fixture
+def world(tmp_path):
+    userlog = str(tmp_path / 'userlog')
+    open(userlog, 'w').close()
+    ads = [{'ClusterId': 10, 'ProcId': 0, 'JobStatus': 2, 'UserLog': userlog},
+           {'ClusterId': 10, 'ProcId': 1, 'JobStatus': 4, 'UserLog': userlog},
+           {'ClusterId': 11, 'ProcId': 0, 'JobStatus': 1, 'UserLog': userlog},
+           {'ClusterId': 13, 'ProcId': 1, 'JobStatus': 5, 'UserLog': userlog}]
+    world = cernworld.CernWorld()
+    world.schedd = FakeSchedd(ads)
+    return world
+
+
+def test_prefetch(world):
+    world.prefetch(['10', '11.0', '10.1', '12'])
+    assert world.schedd.queries == ['member(ClusterId, {10, 11, 12})']
+    # a cluster id has the ads of all its procs
+    assert [ad['ProcId'] for ad in world.jobads['10']] == [0, 1]
+    assert [ad['ClusterId'] for ad in world.jobads['11.0']] == [11]
+    assert [ad['ProcId'] for ad in world.jobads['10.1']] == [1]
+    assert world.jobads['12'] == []
+    # the rest of the run is answered from the prefetched ads
+    assert world.isreallyrunning('10')
+    assert world.isreallyrunning('11.0')
+    assert not world.isreallyrunning('10.1')
+    assert not world.isreallyrunning('12')
+    assert world.getlogfilename('10.1') == world.jobads['10'][1]['UserLog']
+    assert len(world.schedd.queries) == 1
+
+
+def test_jobads_fallback(world):
+    world.prefetch(['10'])
+    assert not world.isreallyrunning('13.1')
+    assert not world.isreallyrunning('13.1')
+    assert world.getlogfilename('13.1') is not None
+    # one query for the submission that was not prefetched, then cached
+    assert world.schedd.queries[1:] == ['ClusterId =?= 13 && ProcId =?= 1']
+    assert [ad['JobStatus'] for ad in world.jobads['13.1']] == [5]
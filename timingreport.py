@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os.path
+import sys
+import campaign
+import simplelogger
+
+# the phases that worker.py and the babysitter time, in the order of a job
+phases = ['queuewait', 'warmup', 'createsdpfiles', 'sdpb', 'cooldown',
+          'analyzer']
+
+
+def collect(logfilenames):
+    """
+    The timing records of the logs: the seconds per phase, the peak memory
+    in kB and the number of runs per host.
+    """
+    seconds = {phase: [] for phase in phases}
+    maxrss = []
+    hosts = {}
+    for logfilename in logfilenames:
+        for entry in simplelogger.SimpleLogReader(logfilename).entries():
+            if len(entry) < 3 or entry[0] != 'tim':
+                continue
+            expr, bonusexpr = entry[1], entry[2]
+            if expr == 'host':
+                hosts[bonusexpr] = hosts.get(bonusexpr, 0) + 1
+                continue
+            try:
+                value = float(bonusexpr)
+            except ValueError:
+                continue
+            if expr == 'maxrss':
+                maxrss.append(value)
+            elif expr in seconds:
+                seconds[expr].append(value)
+    return seconds, maxrss, hosts
+
+
+def percentile(values, p):
+    """
+    The p-th percentile of sorted values, interpolating linearly.
+    """
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * \
+        (position - lower)
+
+
+def summarize(values, percentiles):
+    values = sorted(values)
+    summary = {'count': len(values), 'total': sum(values)}
+    if values:
+        summary['mean'] = summary['total'] / len(values)
+        for p in percentiles:
+            summary['p' + str(p)] = percentile(values, p)
+        summary['max'] = values[-1]
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Aggregate the timing records in the logs of a campaign
+                       into percentiles per phase.""")
+    parser.add_argument('filenames', metavar='fn', nargs='*',
+                        help="""sdp data files (or their logs)""")
+    parser.add_argument('-M', '--manifest',
+                        help="""take all files of a campaign manifest""")
+    parser.add_argument('-p', '--percentiles', type=int, nargs='+',
+                        default=[50, 90, 99],
+                        help="""percentiles to report""")
+    parser.add_argument('--json', action='store_true',
+                        help="""report as JSON""")
+    args = parser.parse_args()
+    if not args.filenames and args.manifest is None:
+        parser.error('no sdp data files or manifest given')
+
+    filenames = list(map(os.path.abspath, args.filenames))
+    if args.manifest is not None:
+        manifest = campaign.Manifest(args.manifest)
+        try:
+            manifest.load()
+        except ValueError as e:
+            parser.error(str(e))
+        filenames += list(manifest.entries)
+    logfilenames = [filename if filename.endswith('.log')
+                    else filename + '.log' for filename in filenames]
+    logfilenames = [logfilename for logfilename in logfilenames
+                    if os.path.isfile(logfilename) or
+                    simplelogger.LogDatabase.find(logfilename) is not None]
+
+    seconds, maxrss, hosts = collect(logfilenames)
+    report = {'phases': {phase: summarize(values, args.percentiles)
+                         for phase, values in seconds.items()},
+              'maxrss': summarize(maxrss, args.percentiles),
+              'hosts': hosts}
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        columns = ['count', 'mean'] + \
+            ['p' + str(p) for p in args.percentiles] + ['max', 'total']
+        print(('{:<16}' + '{:>12}' * len(columns)).format('seconds',
+                                                          *columns))
+        for phase in phases + ['maxrss']:
+            summary = report['maxrss'] if phase == 'maxrss' \
+                else report['phases'][phase]
+            name = 'maxrss (kB)' if phase == 'maxrss' else phase
+            print(('{:<16}' + '{:>12}' * len(columns)).format(
+                name, *[('{:.1f}'.format(summary[column])
+                         if isinstance(summary[column], float)
+                         else str(summary[column]))
+                        if column in summary else '-'
+                        for column in columns]))
+        print(str(len(logfilenames)) + ' logs, runs per host: ' +
+              ', '.join(host + ' ' + str(count)
+                        for host, count in sorted(hosts.items())))
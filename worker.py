@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 import time
+import datetime
+import resource
+import socket
 import sys
 import subprocess
 import os
@@ -22,9 +25,32 @@ world = manyworlds.getworld(args.world)
 
 sdpdata = sdpdatafile.SdpDataFile(args.filename)
 log = simplelogger.SimpleLogWriter('run', sdpdata.logfilename)
+# timing records: the seconds spent per phase, and where we ran
+timelog = simplelogger.SimpleLogWriter('tim', sdpdata.logfilename)
+
+
+def elapsed(start):
+    return '{:.3f}'.format(time.time() - start)
+
+
+submissiontime = simplelogger.LogState.get(sdpdata.logfilename).last.get(
+    'submissiontime')
 log.write('status', 'running')
+if submissiontime is not None:
+    try:
+        queuewait = datetime.datetime.now() - \
+            datetime.datetime.fromisoformat(submissiontime)
+        timelog.write('queuewait',
+                      '{:.3f}'.format(queuewait.total_seconds()))
+    except ValueError:
+        pass
+timelog.write('host', socket.gethostname())
+timelog.write('cpus', len(os.sched_getaffinity(0))
+              if hasattr(os, 'sched_getaffinity') else os.cpu_count())
 
+start = time.time()
 world.warmup(sdpdata, log)
+timelog.write('warmup', elapsed(start))
 
 xmlfiles = sdpdata.xmlfilenames
 if not xmlfiles:
@@ -38,15 +64,47 @@ else:
         try:
             for xmlfile in xmlfiles:
                 world.checkorcreatedir(xmlfile, log)
-            log.write('xmlfilecreation', 'running xml file creator')
             start = time.time()
-            world.createSdpFiles(sdpdata)
-            log.write('xmlfilecreation', 'xml file creator finished')
+            cachekey = None
+            cachehit = False
+            try:
+                cache = world.sdpfilecache(sdpdata)
+                if cache is not None:
+                    cachekey = cache.key(sdpdata,
+                                         world.getsdpfilecreator(sdpdata))
+                    cachehit = cache.fetch(cachekey, xmlfiles)
+            except OSError as e:
+                # e.g. an entry evicted while we took it: create the files
+                log.write('xmlfilecreation', 'cache failed: ' + str(e))
+            if cachehit:
+                log.write('xmlfilecreation', 'file(s) taken from cache')
+                cachenote = ' (cache hit)'
+            else:
+                if cachekey is not None:
+                    # they may be links into the cache, which the creator
+                    # must not overwrite
+                    for xmlfile in xmlfiles:
+                        if os.path.isfile(xmlfile):
+                            os.remove(xmlfile)
+                    cachenote = ' (cache miss)'
+                else:
+                    cachenote = ''
+                log.write('xmlfilecreation', 'running xml file creator')
+                world.createSdpFiles(sdpdata)
+                log.write('xmlfilecreation', 'xml file creator finished')
             finish = time.time()
-            log.write('xmlfilecreation', 'duration: ' + str(finish - start))
+            log.write('xmlfilecreation',
+                      'duration: ' + str(finish - start) + cachenote)
+            timelog.write('createsdpfiles', elapsed(start))
             # check if all files were created
             if all(map(os.path.isfile, xmlfiles)):
                 log.write('xmlfilecreation', 'file(s) created')
+                if cachenote == ' (cache miss)':
+                    try:
+                        cache.store(cachekey, xmlfiles)
+                    except OSError as e:
+                        log.write('xmlfilecreation',
+                                  'cache failed: ' + str(e))
                 xmlsuccess = True
             else:
                 log.write('xmlfilecreation', 'file(s) were not created')
@@ -58,11 +116,38 @@ else:
             log.write('xmlfilecreation', 'file creator not found')
             xmlsuccess = False
 
+# start from the checkpoint of a previous step if we have none of our own
+warmstarted = False
+if sdpdata.warmstartfile is not None and sdpdata.checkpointfile is not None \
+        and not os.path.isfile(sdpdata.checkpointfile):
+    for ckfile in [sdpdata.warmstartfile, sdpdata.warmstartfile + '.bk']:
+        if os.path.isfile(ckfile):
+            world.copyfile(ckfile, sdpdata.checkpointfile, log)
+            log.write('warmstart', ckfile)
+            warmstarted = True
+            break
+    else:
+        log.write('warmstart', 'no checkpoint found, starting cold')
+
 tr = None
 if sdpdata.sdpbargs is not None and xmlsuccess:
     try:
         log.write('starting sdpb')
-        world.runSdpb(sdpdata)
+        start = time.time()
+        try:
+            try:
+                world.runSdpb(sdpdata)
+            except subprocess.CalledProcessError:
+                if not warmstarted:
+                    raise
+                log.write('warmstart', 'checkpoint rejected, starting cold')
+                for ckfile in [sdpdata.checkpointfile,
+                               sdpdata.backupcheckpointfile]:
+                    if os.path.isfile(ckfile):
+                        world.removefile(ckfile, log)
+                world.runSdpb(sdpdata)
+        finally:
+            timelog.write('sdpb', elapsed(start))
         log.write('sdpb finished')
         with open(sdpdata.outfile, 'r') as of:
             # terminateReason
@@ -87,5 +172,10 @@ if sdpdata.sdpbargs is not None and xmlsuccess:
         tr = 'no out file'
         log.write('terminateReason', 'no out file')
 
+start = time.time()
 world.cooldown(sdpdata, tr, log)
+timelog.write('cooldown', elapsed(start))
+# peak resident set size of sdpb and the file creator, in kB
+timelog.write('maxrss',
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
 log.setstatus('finished')